@@ -0,0 +1,58 @@
+# app/albums.py
+# Альбомы (media_group): участники приходят отдельными сообщениями.
+# Первый участник ждёт ALBUM_BUFFER_DELAY, пока подтянутся остальные,
+# затем альбом обрабатывается один раз — результат получают все участники,
+# и те, чья очередь в диспетчере дошла уже после обработки.
+
+import asyncio
+import time
+
+from pyrogram.types import Message
+
+from . import config
+from .logger import logger
+
+
+def _age(msg: Message) -> float:
+    """Сколько секунд назад сообщение появилось (или было правлено)"""
+    moment = msg.edit_date or msg.date
+    return time.time() - moment.timestamp() if moment else float("inf")
+
+
+class AlbumBuffer:
+    def __init__(self, handler):
+        self.handler = handler  # handler(msg) -> (bool, участники), обрабатывает альбом целиком
+        self.pending = {}       # (chat_id, media_group_id) -> Future
+        self.done = {}          # (chat_id, media_group_id) -> (итог, {id участника: edit_date}) за запуск
+        self.tasks = set()
+
+    async def submit(self, msg: Message) -> bool:
+        key = (msg.chat.id, msg.media_group_id)
+        done = self.done.get(key)
+        if done and msg.id in done[1] and done[1][msg.id] == msg.edit_date:
+            # альбом уже обработан с этой версией участника — не запрашиваем его снова
+            return done[0]
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            task = asyncio.create_task(self._run(key, future, msg))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        # таймаут одного участника не должен обрывать обработку всего альбома
+        return await asyncio.shield(future)
+
+    async def _run(self, key, future, msg: Message):
+        result = False
+        try:
+            # из истории альбом приходит целиком — ждать имеет смысл только живые апдейты
+            if _age(msg) < config.ALBUM_BUFFER_DELAY:
+                await asyncio.sleep(config.ALBUM_BUFFER_DELAY)
+            result, members = await self.handler(msg)
+            self.done[key] = (result, {m.id: m.edit_date for m in members})
+        except Exception as e:
+            logger.error(f"❌ Error processing album {key[1]}: {e}")
+        finally:
+            self.pending.pop(key, None)
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,148 @@
+# app/backfill.py
+# Потоковый backfill: страницы истории читаются от старых к новым
+# и через ограниченную очередь сразу уходят в обработку,
+# пока следующие страницы ещё качаются.
+
+import asyncio
+from collections import deque
+from datetime import datetime
+
+from pyrogram import Client, raw, utils
+
+from . import config, db
+from .logger import logger
+
+_DONE = object()
+
+
+async def history_page(client: Client, chat_id, after_id: int, limit: int):
+    """До limit сообщений с id > after_id, по возрастанию id"""
+    messages = await client.invoke(
+        raw.functions.messages.GetHistory(
+            peer=await client.resolve_peer(chat_id),
+            offset_id=after_id + 1,
+            offset_date=0,
+            add_offset=-limit,  # отрицательный сдвиг — сообщения новее offset_id
+            limit=limit,
+            max_id=0,
+            min_id=after_id,
+            hash=0
+        ),
+        sleep_threshold=60
+    )
+    messages = await utils.parse_messages(client, messages, replies=0)
+    return sorted((m for m in messages if m.id > after_id and not m.empty), key=lambda m: m.id)
+
+
+async def _nth_id(client: Client, chat_id, offset: int, offset_id: int = 0):
+    """id offset-го (с нуля) сообщения, считая от новых (и от offset_id, если задан)"""
+    async for m in client.get_chat_history(chat_id, limit=1, offset=offset, offset_id=offset_id):
+        return m.id
+    return None
+
+
+async def start_cursor(client: Client, chat_id, last_id, edit_horizon=None):
+    """
+    С какого id (не включая) начинать:
+    не глубже BACKFILL_LIMIT последних сообщений, а при чекпоинте —
+    не глубже BACKFILL_EDIT_WINDOW сообщений ниже него: с сохранённой
+    прошлым запуском границы окна правок или, если её нет, найденной запросом истории.
+    """
+    limit_id = await _nth_id(client, chat_id, config.BACKFILL_LIMIT - 1)
+    cursor = limit_id - 1 if limit_id else 0
+
+    if last_id and config.BACKFILL_EDIT_WINDOW <= 0:
+        cursor = max(cursor, last_id)
+    elif edit_horizon:
+        cursor = max(cursor, edit_horizon - 1)
+    elif last_id:
+        window_id = await _nth_id(client, chat_id, config.BACKFILL_EDIT_WINDOW - 1, offset_id=last_id + 1)
+        cursor = max(cursor, window_id - 1 if window_id else 0)
+
+    return cursor
+
+
+async def _produce(client: Client, chat_id, cursor: int, queue: asyncio.Queue):
+    try:
+        while True:
+            page = await history_page(client, chat_id, cursor, config.BACKFILL_PAGE_SIZE)
+            if not page:
+                break
+            # записи БД для всей страницы — одним запросом
+            states = await db.get_message_states(str(page[0].chat.id), [m.id for m in page])
+            for m in page:
+                await queue.put((m, states))
+            cursor = page[-1].id
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        await queue.put(_DONE)
+        raise
+    await queue.put(_DONE)
+
+
+async def backfill_channel(client: Client, src, submit):
+    """
+    submit(msg, states) -> Future[bool] — постановка сообщения в диспетчер,
+    states — записи БД страницы (db.get_message_states).
+    Чекпоинт канала двигается только по сплошь обработанному префиксу;
+    вместе с ним сохраняется граница окна правок — id, с которого следующий
+    запуск перечитает последние BACKFILL_EDIT_WINDOW обработанных сообщений.
+    """
+    last_id, last_horizon = await db.get_channel_checkpoint(src)
+    if last_id:
+        logger.info(f"Checkpoint {src}: last_message_id={last_id}, edit_horizon_id={last_horizon}")
+
+    cursor = await start_cursor(client, src, last_id, last_horizon)
+    logger.info(f"Streaming {src} from message ID > {cursor}")
+
+    queue = asyncio.Queue(maxsize=config.BACKFILL_QUEUE_SIZE)
+    producer = asyncio.create_task(_produce(client, src, cursor, queue))
+
+    checkpoint = last_id or 0
+    window = deque(maxlen=max(config.BACKFILL_EDIT_WINDOW, 1))  # последние id под чекпоинтом
+    failed = False
+    count = 0
+    in_flight = deque()  # (id, future) в порядке канала
+
+    async def settle(block: bool):
+        """Забрать результаты готового префикса (или дождаться первого)"""
+        nonlocal checkpoint, failed
+        while in_flight and (block or in_flight[0][1].done()):
+            msg_id, future = in_flight.popleft()
+            ok = await future
+            if not ok:
+                failed = True
+            elif not failed:
+                checkpoint = max(checkpoint, msg_id)
+                window.append(msg_id)
+            block = False
+
+    try:
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            m, states = item
+
+            count += 1
+            logger.info(f"Queued #{count} (message ID: {m.id})")
+
+            in_flight.append((m.id, submit(m, states)))
+            await settle(block=len(in_flight) >= config.BACKFILL_QUEUE_SIZE)
+
+        while in_flight:
+            await settle(block=True)
+
+        # ошибка чтения истории всплывает здесь, после обработки уже полученного
+        await producer
+        logger.info(f"✅ Processed {count} messages from {src} in correct order")
+    finally:
+        if not producer.done():
+            producer.cancel()
+        # окно считается по id, пройденным в этом запуске: начинали с прошлой границы,
+        # так что при малом числе новых сообщений в него попадают и старые
+        edit_horizon = window[0] if window else last_horizon
+        if checkpoint and (checkpoint, edit_horizon) != (last_id, last_horizon):
+            await db.set_channel_checkpoint(src, checkpoint, edit_horizon, datetime.utcnow().isoformat())
+            logger.info(f"Checkpoint {src} -> {checkpoint}, edit horizon {edit_horizon}")
@@ -22,15 +22,87 @@ PRICE_PRO_DELTA = 2000.0
 PRICE_DEFAULT_DELTA = 1000.0
 MIN_PRICE_TO_ZERO = True
 MIN_PRICE_TO_IGNORE = float(os.getenv("MIN_PRICE_TO_IGNORE", 10000.0))
+# как часто перечитывать таблицу правил из settings (сек)
+PRICE_RULES_RELOAD_INTERVAL = float(os.getenv("PRICE_RULES_RELOAD_INTERVAL", 60.0))
 
 # ---------- Тайминги ----------
-REQUEST_DELAY = float(os.getenv("REQUEST_DELAY", 0.45))
+# пауза между сообщениями одного канала; вызовы бота дозирует rate_limit
+REQUEST_DELAY = float(os.getenv("REQUEST_DELAY", 0.0))
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", 4))  # подготовок сообщений одновременно
+# сколько следующих сообщений канала готовить, пока текущее ждёт публикации
+DISPATCH_PREFETCH = int(os.getenv("DISPATCH_PREFETCH", 4))
+# на сколько секунд позже считается поставленным сообщение каждого следующего
+# класса приоритета (новые посты, правки цен, косметические правки, backfill)
+PRIORITY_AGING = float(os.getenv("PRIORITY_AGING", 30.0))
+# правка ждёт столько секунд тишины (0 — сразу), но не дольше EDIT_DEBOUNCE_MAX с первой
+EDIT_DEBOUNCE_WINDOW = float(os.getenv("EDIT_DEBOUNCE_WINDOW", 5.0))
+EDIT_DEBOUNCE_MAX = float(os.getenv("EDIT_DEBOUNCE_MAX", 30.0))
+
+# ---------- Лимиты вызовов бота (AIMD, вызовов/сек на семейство методов и чат) ----------
+RATE_LIMIT_SEND = float(os.getenv("RATE_LIMIT_SEND", 0.33))    # стартовая, если не выучена
+RATE_LIMIT_EDIT = float(os.getenv("RATE_LIMIT_EDIT", 0.5))
+RATE_LIMIT_MIN = float(os.getenv("RATE_LIMIT_MIN", 0.02))
+RATE_LIMIT_MAX = float(os.getenv("RATE_LIMIT_MAX", 1.0))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", 3))
+RATE_LIMIT_INCREASE = float(os.getenv("RATE_LIMIT_INCREASE", 0.005))  # + за успешный вызов
+RATE_LIMIT_DECREASE = float(os.getenv("RATE_LIMIT_DECREASE", 0.5))    # x при FloodWait
 DOWNLOAD_DIR = os.getenv("DOWNLOAD_DIR", "downloads")
+MEDIA_DISK_QUOTA = int(os.getenv("MEDIA_DISK_QUOTA", 2 * 1024 ** 3))  # байт в DOWNLOAD_DIR; 0 — без ограничения
+MEDIA_STALE_AGE = float(os.getenv("MEDIA_STALE_AGE", 3600))           # старше — удаляется при старте
+# недокачанные файлы (partial/) ждут докачки следующим запуском — cron идёт раз в 6–18 ч
+MEDIA_PARTIAL_STALE_AGE = float(os.getenv("MEDIA_PARTIAL_STALE_AGE", 3 * 24 * 3600))
 DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 3))
+# параллельных скачиваний у читателя (max_concurrent_transmissions), в т.ч. диапазонов одного файла
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", 4))
 ALBUM_BUFFER_DELAY = float(os.getenv("ALBUM_BUFFER_DELAY", 1.0))
 
+# ---------- Медиа ----------
+# публикация медиа без скачивания: файлы, уже загруженные ботом (media_cache,
+# photo_index), используются всегда; auto / copy — ещё и copy_message исходника;
+# cached / off — без него, иначе скачать и загрузить заново
+MEDIA_REUSE_MODE = os.getenv("MEDIA_REUSE_MODE", "auto")
+# файлы до этого размера передаются от читателя боту в памяти, крупнее — через DOWNLOAD_DIR
+MEDIA_MEMORY_LIMIT = int(os.getenv("MEDIA_MEMORY_LIMIT", 20 * 1024 * 1024))
+# исходный file_unique_id -> file_id загруженного ботом файла; 0 — выключено
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", 5000))
+
+# ---------- Пережатие фото (нужен Pillow) ----------
+IMAGE_RECOMPRESS = os.getenv("IMAGE_RECOMPRESS", "0") == "1"
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 1920))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+# с водяным знаком фото исходника не переиспользуются (copy_message / send_cached_media)
+WATERMARK_PATH = os.getenv("WATERMARK_PATH", "")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))                      # процессов
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+
+# ---------- Похожие фото (dHash, нужен Pillow) ----------
+# по умолчанию выключено: у прайсов фото с другой наклейкой или ценой — тоже «похожее»
+PHASH_DEDUPE = os.getenv("PHASH_DEDUPE", "0") == "1"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", 4))   # из 64 бит
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", 20000))
+
+# ---------- Кэш преобразования текста ----------
+TRANSFORM_CACHE_SIZE = int(os.getenv("TRANSFORM_CACHE_SIZE", 2000))          # записей
+TRANSFORM_CACHE_MAX_CHARS = int(os.getenv("TRANSFORM_CACHE_MAX_CHARS", 8_000_000))
+TRANSFORM_CACHE_PERSIST = os.getenv("TRANSFORM_CACHE_PERSIST", "1") == "1"  # хранить в reposter.db
+TRANSFORM_CACHE_PERSIST_LIMIT = int(os.getenv("TRANSFORM_CACHE_PERSIST_LIMIT", 500))  # БД коммитится в git
+
+# ---------- БД ----------
+DB_COMMIT_BATCH = int(os.getenv("DB_COMMIT_BATCH", 50))                # записей на транзакцию
+DB_COMMIT_INTERVAL_MS = float(os.getenv("DB_COMMIT_INTERVAL_MS", 500))  # не реже, чем раз в
+
 # ---------- Backfill ----------
 BACKFILL_LIMIT = int(os.getenv("BACKFILL_LIMIT", 70))
+# сколько уже обработанных сообщений ниже чекпоинта перечитывать ради правок
+BACKFILL_EDIT_WINDOW = int(os.getenv("BACKFILL_EDIT_WINDOW", 20))
+BACKFILL_PAGE_SIZE = int(os.getenv("BACKFILL_PAGE_SIZE", 100))    # сообщений за запрос истории
+BACKFILL_QUEUE_SIZE = int(os.getenv("BACKFILL_QUEUE_SIZE", 100))  # буфер между чтением и обработкой
+
+# ---------- Режим запуска ----------
+# backfill — история каналов; resync — перепроверка уже опубликованных постов
+RUN_MODE = os.getenv("RUN_MODE", "backfill")
+RESYNC_DAYS = float(os.getenv("RESYNC_DAYS", 3))
+RESYNC_BATCH_SIZE = min(int(os.getenv("RESYNC_BATCH_SIZE", 200)), 200)  # лимит get_messages
 
 # ---------- Логи ----------
 LOG_DIR = os.getenv("LOG_DIR", "logs")
@@ -40,8 +112,12 @@ LOG_BACKUP_COUNT = 5
 # config.py - добавьте в конец:
 
 # ================= ТАЙМАУТЫ =================
-MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", 3))           # попыток одного вызова бота
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 30.0))
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 120.0))  # вызовы с загрузкой файла
+RETRY_BUDGET = int(os.getenv("RETRY_BUDGET", 5))          # повторов на все вызовы одного сообщения
+RETRY_BACKOFF = float(os.getenv("RETRY_BACKOFF", 1.0))    # база паузы, удваивается
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", 30.0))
 MESSAGE_PROCESS_TIMEOUT = float(os.getenv("MESSAGE_PROCESS_TIMEOUT", 60.0))
 TOTAL_BOT_TIMEOUT = float(os.getenv("TOTAL_BOT_TIMEOUT", 600.0))  # 10 минут
 
@@ -1,5 +1,7 @@
 # app/db.py
 import aiosqlite
+import asyncio
+import itertools
 import os
 import sqlite3
 from pathlib import Path
@@ -11,6 +13,18 @@ DB_PATH = BASE_DIR / "reposter.db"
 
 db_conn = None  # persistent connection
 
+# Group commit: частые записи (messages, errors) копятся в очереди и
+# одним фоновым писателем коммитятся пачкой — раз в DB_COMMIT_INTERVAL_MS
+# или при DB_COMMIT_BATCH записях. Пока запись не закоммичена, чтения
+# messages и media_cache видят её через _overlay. Редкие записи, которым
+# нужна немедленная надёжность, коммитятся вместе с очередью (_commit_now).
+_pending = []       # (sql, params)
+# (source_channel, source_message_id) | ("media_cache", unique_id) -> (full_row, {колонка: значение})
+_overlay = {}
+_pending_event = None
+_flush_lock = None
+_writer_task = None
+
 
 async def init_db():
     global db_conn
@@ -63,6 +77,12 @@ async def init_db():
     
     # Включаем поддержку ON CONFLICT
     await db_conn.execute("PRAGMA foreign_keys = ON")
+    # NORMAL: коммит без лишнего fsync. Журнал — DELETE, не WAL: в git уходит
+    # только reposter.db, и после каждого коммита он должен быть полным, даже
+    # если процесс убит раньше close_db
+    async with db_conn.execute("PRAGMA journal_mode = DELETE") as cur:
+        await cur.fetchall()
+    await db_conn.execute("PRAGMA synchronous = NORMAL")
     
     # Создаем таблицы если их еще нет (на всякий случай)
     await db_conn.execute("""
@@ -92,6 +112,45 @@ async def init_db():
             value TEXT
         );
     """)
+    # Новые колонки в старых БД (reposter.db живёт в репозитории)
+    await _ensure_columns("messages", {
+        "text_fingerprint": "TEXT",
+        "source_edit_date": "INTEGER",
+        "raw_hash": "TEXT",
+        "media_unique_id": "TEXT",
+    })
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS channel_state (
+            source_channel TEXT PRIMARY KEY,
+            last_message_id INTEGER,
+            edit_horizon_id INTEGER,
+            updated_at TEXT
+        );
+    """)
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS transform_cache (
+            key TEXT PRIMARY KEY,
+            text TEXT,
+            changed INTEGER,
+            used_at REAL
+        );
+    """)
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS media_cache (
+            unique_id TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            used_at REAL
+        );
+    """)
+    await db_conn.execute("""
+        CREATE TABLE IF NOT EXISTS photo_hashes (
+            unique_id TEXT PRIMARY KEY,
+            hash INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            used_at REAL
+        );
+    """)
+    await db_conn.execute("CREATE INDEX IF NOT EXISTS idx_photo_hashes_hash ON photo_hashes(hash)")
     await db_conn.commit()
     
     # Проверяем сколько записей уже есть
@@ -99,26 +158,149 @@ async def init_db():
         count = await cur.fetchone()
         print(f"[DB] Total messages in database: {count[0]}")
 
+    _start_writer()
+
+
+# ================= GROUP COMMIT =================
+
+def _start_writer():
+    global _pending_event, _flush_lock, _writer_task
+    _pending_event = asyncio.Event()
+    _flush_lock = asyncio.Lock()
+    _writer_task = asyncio.create_task(_writer_loop())
+
+
+async def _writer_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_pending_event.wait(), timeout=config.DB_COMMIT_INTERVAL_MS / 1000)
+        except asyncio.TimeoutError:
+            pass
+        _pending_event.clear()
+        try:
+            # shield: отмена писателя в close_db не должна оборвать коммит на середине
+            await asyncio.shield(flush())
+        except Exception as e:
+            print(f"[DB] Group commit failed: {e}")
+
+
+def _enqueue(sql, params, key=None, row=None, full_row=False):
+    """Поставить запись в очередь; row — что увидят чтения до коммита"""
+    _pending.append((sql, params))
+    if key is not None:
+        old = _overlay.get(key)
+        if full_row or old is None:
+            _overlay[key] = (full_row, dict(row))
+        else:
+            _overlay[key] = (old[0], {**old[1], **row})
+    if len(_pending) >= config.DB_COMMIT_BATCH:
+        _pending_event.set()
+
+
+async def flush():
+    """Закоммитить всё накопленное одной транзакцией"""
+    if not _pending:
+        return
+    async with _flush_lock:
+        batch = _pending[:]
+        del _pending[:]
+        flushed = list(_overlay.items())
+
+        try:
+            for sql, group in itertools.groupby(batch, key=lambda item: item[0]):
+                await db_conn.executemany(sql, [params for _, params in group])
+            await db_conn.commit()
+        except BaseException:
+            # пачка целиком возвращается в начало очереди, _overlay её по-прежнему показывает
+            await db_conn.rollback()
+            _pending[:0] = batch
+            raise
+
+        for key, entry in flushed:
+            if _overlay.get(key) is entry:
+                del _overlay[key]
+
+
+async def _commit_now(sql, params):
+    """
+    Записать сразу и надёжно — одной транзакцией после всего, что уже в очереди:
+    иначе, например, чекпоинт мог бы стать надёжнее записей о сообщениях под ним
+    """
+    _pending.append((sql, params))
+    await flush()
+
+
+def _apply_overlay(key, state):
+    entry = _overlay.get(key)
+    if entry is None:
+        return state
+    full_row, row = entry
+    if full_row:
+        return dict(row)
+    # частичное обновление без строки в БД — UPDATE ничего не изменит
+    return {**state, **row} if state else None
+
+
+async def _ensure_columns(table, columns):
+    """ALTER TABLE ADD COLUMN для колонок, которых ещё нет"""
+    async with db_conn.execute(f"PRAGMA table_info({table})") as cur:
+        existing = {row[1] for row in await cur.fetchall()}
+    for name, col_type in columns.items():
+        if name not in existing:
+            await db_conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+            print(f"[DB] Added column {table}.{name}")
+
 
 async def get_message_target(source_channel, source_message_id):
-    async with db_conn.execute(
-        "SELECT target_message_id FROM messages WHERE source_channel=? AND source_message_id=?",
-        (source_channel, source_message_id)
-    ) as cur:
-        row = await cur.fetchone()
-        return row[0] if row else None
+    state = await get_message_state(source_channel, source_message_id)
+    return state["target_message_id"] if state else None
 
 
 async def get_message_target_with_text(source_channel, source_message_id):
     """Получаем target_id и текст сообщения из базы"""
+    state = await get_message_state(source_channel, source_message_id)
+    if state:
+        return state["target_message_id"], state["summary"]  # target_id, text
+    return None, None  # Если записи нет
+
+
+async def get_message_state(source_channel, source_message_id):
+    """Вся запись о сообщении словарём (или None)"""
     async with db_conn.execute(
-        "SELECT target_message_id, summary FROM messages WHERE source_channel=? AND source_message_id=?",
+        "SELECT * FROM messages WHERE source_channel=? AND source_message_id=?",
         (source_channel, source_message_id)
     ) as cur:
         row = await cur.fetchone()
-        if row:
-            return row[0], row[1]  # target_id, text
-        return None, None  # Если записи нет
+        state = dict(zip((d[0] for d in cur.description), row)) if row else None
+    return _apply_overlay((source_channel, source_message_id), state)
+
+
+async def get_message_states(source_channel, source_message_ids):
+    """
+    Записи сразу для пачки сообщений одним IN-запросом:
+    {source_message_id: state}; сообщений без записи в словаре нет.
+    """
+    states = {}
+    ids = list(source_message_ids)
+    for start in range(0, len(ids), 500):  # лимит переменных SQLite
+        chunk = ids[start:start + 500]
+        placeholders = ",".join("?" * len(chunk))
+        async with db_conn.execute(
+            f"SELECT * FROM messages WHERE source_channel=? AND source_message_id IN ({placeholders})",
+            (source_channel, *chunk)
+        ) as cur:
+            columns = [d[0] for d in cur.description]
+            for row in await cur.fetchall():
+                state = dict(zip(columns, row))
+                states[state["source_message_id"]] = state
+
+    for source_message_id in ids:
+        key = (source_channel, source_message_id)
+        if key in _overlay:
+            state = _apply_overlay(key, states.get(source_message_id))
+            if state:
+                states[source_message_id] = state
+    return states
 
 
 async def update_message_target(
@@ -127,29 +309,48 @@ async def update_message_target(
     target_message_id,
     processed_at,
     summary,
-    message_type="text"
+    message_type="text",
+    text_fingerprint=None,
+    source_edit_date=None,
+    raw_hash=None,
+    media_unique_id=None
 ):
-    # Используем INSERT OR REPLACE для простоты
-    await db_conn.execute("""
+    # Используем INSERT OR REPLACE для простоты; коммит — пачкой (group commit)
+    row = {
+        "source_channel": source_channel,
+        "source_message_id": source_message_id,
+        "target_message_id": target_message_id,
+        "message_type": message_type,
+        "processed_at": processed_at,
+        "summary": summary,
+        "text_fingerprint": text_fingerprint,
+        "source_edit_date": source_edit_date,
+        "raw_hash": raw_hash,
+        "media_unique_id": media_unique_id,
+    }
+    _enqueue("""
         INSERT OR REPLACE INTO messages (
             source_channel, source_message_id,
             target_message_id, message_type,
-            processed_at, summary
+            processed_at, summary, text_fingerprint,
+            source_edit_date, raw_hash, media_unique_id
         )
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (
-        source_channel,
-        source_message_id,
-        target_message_id,
-        message_type,
-        processed_at,
-        summary
-    ))
-    await db_conn.commit()
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, tuple(row.values()), key=(source_channel, source_message_id), row=row, full_row=True)
+
+
+async def update_message_source(source_channel, source_message_id, source_edit_date, raw_hash, media_unique_id=None):
+    """Запомнить версию исходника, когда публиковать было нечего"""
+    _enqueue("""
+        UPDATE messages SET source_edit_date=?, raw_hash=?, media_unique_id=?
+        WHERE source_channel=? AND source_message_id=?
+    """, (source_edit_date, raw_hash, media_unique_id, source_channel, source_message_id),
+        key=(source_channel, source_message_id),
+        row={"source_edit_date": source_edit_date, "raw_hash": raw_hash, "media_unique_id": media_unique_id})
 
 
 async def save_error(source_channel, source_message_id, error_text, traceback_text, created_at):
-    await db_conn.execute("""
+    _enqueue("""
         INSERT INTO errors(
             source_channel, source_message_id,
             error_text, traceback, created_at
@@ -162,11 +363,144 @@ async def save_error(source_channel, source_message_id, error_text, traceback_te
         traceback_text,
         created_at
     ))
-    await db_conn.commit()
+
+
+async def get_setting(key, default=None):
+    async with db_conn.execute(
+        "SELECT value FROM settings WHERE key=?", (key,)
+    ) as cur:
+        row = await cur.fetchone()
+        return row[0] if row else default
+
+
+async def set_setting(key, value):
+    await _commit_now(
+        "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+        (key, str(value))
+    )
+
+
+async def get_known_message_ids(source_channel, processed_since):
+    """id опубликованных исходников канала, обработанных не раньше processed_since (ISO)"""
+    await flush()
+    async with db_conn.execute("""
+        SELECT source_message_id FROM messages
+        WHERE source_channel=? AND target_message_id IS NOT NULL AND processed_at >= ?
+        ORDER BY source_message_id
+    """, (source_channel, processed_since)) as cur:
+        return [row[0] for row in await cur.fetchall()]
+
+
+async def get_channel_checkpoint(source_channel):
+    """(last_message_id, edit_horizon_id) последнего backfill или (None, None)"""
+    async with db_conn.execute(
+        "SELECT last_message_id, edit_horizon_id FROM channel_state WHERE source_channel=?",
+        (source_channel,)
+    ) as cur:
+        row = await cur.fetchone()
+        return (row[0], row[1]) if row else (None, None)
+
+
+async def set_channel_checkpoint(source_channel, last_message_id, edit_horizon_id, updated_at):
+    await _commit_now("""
+        INSERT OR REPLACE INTO channel_state (
+            source_channel, last_message_id, edit_horizon_id, updated_at
+        )
+        VALUES (?, ?, ?, ?)
+    """, (source_channel, last_message_id, edit_horizon_id, updated_at))
+
+
+async def load_transform_cache(limit):
+    """Последние использованные результаты преобразования текста"""
+    async with db_conn.execute(
+        "SELECT key, text, changed FROM transform_cache ORDER BY used_at DESC LIMIT ?",
+        (limit,)
+    ) as cur:
+        return await cur.fetchall()
+
+
+async def save_transform_cache(rows, keep):
+    """rows: (key, text, changed, used_at); в таблице остаются keep самых свежих"""
+    for row in rows:
+        _pending.append(("""
+            INSERT OR REPLACE INTO transform_cache (key, text, changed, used_at)
+            VALUES (?, ?, ?, ?)
+        """, row))
+    await _commit_now("""
+        DELETE FROM transform_cache WHERE key NOT IN (
+            SELECT key FROM transform_cache ORDER BY used_at DESC LIMIT ?
+        )
+    """, (keep,))
+
+
+async def get_cached_file_id(unique_id):
+    """file_id на стороне бота для исходного file_unique_id (или None)"""
+    async with db_conn.execute(
+        "SELECT file_id FROM media_cache WHERE unique_id=?", (unique_id,)
+    ) as cur:
+        row = await cur.fetchone()
+    state = _apply_overlay(("media_cache", unique_id), {"file_id": row[0]} if row else None)
+    return state["file_id"] if state else None
+
+
+async def touch_cached_file(unique_id, used_at):
+    _enqueue("UPDATE media_cache SET used_at=? WHERE unique_id=?", (used_at, unique_id))
+
+
+async def put_cached_file(unique_id, file_id, used_at):
+    """Запомнить загруженный файл (лишнее убирает prune_media_cache)"""
+    _enqueue("""
+        INSERT OR REPLACE INTO media_cache (unique_id, file_id, used_at)
+        VALUES (?, ?, ?)
+    """, (unique_id, file_id, used_at), ("media_cache", unique_id), {"file_id": file_id}, full_row=True)
+
+
+async def prune_media_cache(keep):
+    """В таблице остаются keep самых свежих записей"""
+    _enqueue("""
+        DELETE FROM media_cache WHERE unique_id NOT IN (
+            SELECT unique_id FROM media_cache ORDER BY used_at DESC LIMIT ?
+        )
+    """, (keep,))
+
+
+async def delete_cached_file(unique_id):
+    _enqueue(
+        "DELETE FROM media_cache WHERE unique_id=?", (unique_id,),
+        ("media_cache", unique_id), {"file_id": None}, full_row=True
+    )
+
+
+async def load_photo_hashes(keep):
+    """(hash, file_id) для keep самых свежих фото; более старые удаляются"""
+    await _commit_now("""
+        DELETE FROM photo_hashes WHERE unique_id NOT IN (
+            SELECT unique_id FROM photo_hashes ORDER BY used_at DESC LIMIT ?
+        )
+    """, (keep,))
+    async with db_conn.execute("SELECT hash, file_id FROM photo_hashes") as cur:
+        return await cur.fetchall()
+
+
+async def put_photo_hash(unique_id, hash_value, file_id, used_at):
+    _enqueue("""
+        INSERT OR REPLACE INTO photo_hashes (unique_id, hash, file_id, used_at)
+        VALUES (?, ?, ?, ?)
+    """, (unique_id, hash_value, file_id, used_at))
+
+
+async def delete_photo_hashes(file_id):
+    _enqueue("DELETE FROM photo_hashes WHERE file_id=?", (file_id,))
 
 
 async def close_db():
-    """Закрыть соединение с БД"""
+    """Закрыть соединение с БД (сначала дописав очередь group commit)"""
+    if _writer_task:
+        _writer_task.cancel()
+        await asyncio.gather(_writer_task, return_exceptions=True)
     if db_conn:
-        await db_conn.close()
+        try:
+            await flush()
+        finally:
+            await db_conn.close()
         print("[DB] Database connection closed")
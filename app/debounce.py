@@ -0,0 +1,60 @@
+# app/debounce.py
+# Поставщики правят один прайс по нескольку раз за минуту. Правка ждёт
+# EDIT_DEBOUNCE_WINDOW секунд тишины; более новая версия того же
+# (канал, id) заменяет ожидающую, и в обработку уходит только последняя.
+# Непрерывно правимое сообщение ждёт не дольше EDIT_DEBOUNCE_MAX.
+
+import asyncio
+
+from pyrogram.types import Message
+
+from . import config
+from .logger import logger
+
+
+class EditDebouncer:
+    def __init__(self, target):
+        self.target = target    # target(msg) — постановка в диспетчер
+        self.pending = {}       # (chat_id, msg_id) -> (msg, время первой правки, TimerHandle)
+        self.superseded = 0
+        self.closed = False     # после flush() правки идут в обработку сразу
+
+    def submit(self, msg: Message):
+        window = config.EDIT_DEBOUNCE_WINDOW
+        if window <= 0 or self.closed:
+            self.target(msg)
+            return
+
+        loop = asyncio.get_running_loop()
+        key = (msg.chat.id, msg.id)
+        now = loop.time()
+        first = now
+        old = self.pending.get(key)
+        if old:
+            old_msg, first, handle = old
+            handle.cancel()
+            self.superseded += 1
+            # апдейты могут прийти не по порядку — оставляем более позднюю правку
+            if old_msg.edit_date and msg.edit_date and old_msg.edit_date > msg.edit_date:
+                msg = old_msg
+            logger.info(f"Edit of message {msg.id} superseded, waiting {window:g}s more")
+
+        delay = min(window, max(0.0, first + config.EDIT_DEBOUNCE_MAX - now))
+        self.pending[key] = (msg, first, loop.call_later(delay, self._fire, key))
+
+    def _fire(self, key):
+        msg, _, _ = self.pending.pop(key)
+        self.target(msg)
+
+    def flush(self):
+        """
+        Отдать в обработку все ожидающие правки сразу (перед завершением);
+        правки, пришедшие позже, уже не откладываются — их дождётся dispatcher.join()
+        """
+        self.closed = True
+        for key in list(self.pending):
+            self.pending[key][2].cancel()
+            self._fire(key)
+
+    def stats(self) -> str:
+        return f"pending={len(self.pending)} superseded={self.superseded}"
@@ -0,0 +1,194 @@
+# app/dispatcher.py
+# Общий диспетчер обработки. Сообщение проходит два этапа:
+# подготовка (БД, преобразование текста, поиск file_id, скачивание медиа)
+# и публикация ботом. Каналы идут параллельно, внутри канала публикуется
+# одно сообщение за раз — следующим берётся самое приоритетное (priority):
+# свежий пост не ждёт сотню перепроверок backfill. Внутри класса порядок
+# поступления сохраняется, новые посты канала выходят по порядку id,
+# версия сообщения не обгоняет предыдущую. Класс правки уточняется, как
+# только закончена её подготовка.
+# Подготовка идёт с опережением на DISPATCH_PREFETCH сообщений: пока
+# публикация канала ждёт окончания FloodWait (его держит только корзина
+# rate_limit), следующие сообщения уже скачаны и преобразованы.
+# Живые апдейты и backfill идут через него же.
+
+import asyncio
+import heapq
+import time
+
+from pyrogram.types import Message
+
+from . import config, priority, retry
+from .logger import logger
+
+
+class _Job:
+    __slots__ = ("msg", "states", "future", "prepared", "level", "since", "order")
+
+    def __init__(self, msg: Message, states, future: asyncio.Future, level: int):
+        self.msg = msg
+        self.states = states
+        self.future = future
+        self.prepared = None  # задача подготовки, когда запущена
+        self.level = level    # класс priority
+        self.since = priority.stamp()
+        self.order = self.since  # место в очереди; у новых постов — по порядку id
+
+    def key(self) -> tuple:
+        return priority.make_key(self.level, self.order)
+
+
+class Dispatcher:
+    def __init__(self, prepare, workers: int):
+        # prepare(msg, states) -> bool | async publish() -> bool;
+        # у publish может быть discard() — освободить подготовленное, если публикации не будет
+        self.prepare = prepare
+        self.slots = asyncio.Semaphore(workers)  # подготовок одновременно
+        self.queues = {}            # chat_id -> list[_Job] в порядке поступления
+        self.runners = {}           # chat_id -> задача публикации канала
+        self.latency = {}           # класс -> [опубликовано, сумма секунд, максимум]
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def submit(self, msg: Message, states=None, level: int = priority.NEW) -> asyncio.Future:
+        """Поставить сообщение в очередь его канала; future получит итог (bool)"""
+        future = asyncio.get_running_loop().create_future()
+        channel = msg.chat.id
+        self.queues.setdefault(channel, []).append(_Job(msg, states, future, level))
+        if level == priority.NEW:
+            self._order_new(channel)
+        if channel not in self.runners:
+            self.idle.clear()
+            self.runners[channel] = asyncio.create_task(self._run(channel))
+        else:
+            self._prefetch(channel)
+        return future
+
+    def _eligible(self, channel) -> list:
+        """
+        Кандидаты на публикацию: правку того же сообщения берём только после
+        публикации предыдущей версии — иначе она прочитает из БД состояние до неё
+        """
+        seen, eligible = set(), []
+        for job in self.queues[channel]:
+            if job.msg.id not in seen:
+                eligible.append(job)
+                seen.add(job.msg.id)
+        return eligible
+
+    def _order_new(self, channel):
+        """
+        Новые посты канала — по порядку id: ещё не опубликованный пост из
+        backfill живые не обгоняют. Места в очереди переставляются между ними
+        """
+        jobs = [job for job in self.queues[channel] if job.level == priority.NEW]
+        orders = sorted(job.order for job in jobs)
+        for job, order in zip(sorted(jobs, key=lambda job: job.msg.id), orders):
+            job.order = order
+
+    def _prefetch(self, channel):
+        """Запустить подготовку DISPATCH_PREFETCH + 1 самых приоритетных"""
+        for job in heapq.nsmallest(config.DISPATCH_PREFETCH + 1, self._eligible(channel), key=_Job.key):
+            if job.prepared is None:
+                job.prepared = asyncio.create_task(self._prepare(job))
+
+    async def _prepare(self, job: _Job):
+        async with self.slots:
+            try:
+                result = await asyncio.wait_for(
+                    self.prepare(job.msg, job.states),
+                    timeout=config.MESSAGE_PROCESS_TIMEOUT
+                )
+                self._reclassify(job, result)
+                return result
+            except asyncio.TimeoutError:
+                logger.error(f"Timeout processing message {job.msg.id}, skipping")
+            except Exception as e:
+                logger.error(f"❌ Error processing message {job.msg.id}: {e}")
+            return False
+
+    def _reclassify(self, job: _Job, result):
+        """
+        Подготовка знает, чем на деле оказалось сообщение: живая правка — меняет
+        ли она цены (или это первая публикация), перепроверка backfill — не
+        новый ли это пост
+        """
+        level = getattr(result, "priority", job.level)
+        if job.level == priority.EDIT or (job.level == priority.BACKFILL and level == priority.NEW):
+            job.level = level
+            if level == priority.NEW:
+                self._order_new(job.msg.chat.id)
+
+    async def _publish(self, job: _Job) -> bool:
+        # без общего таймаута: ожидание FloodWait не сбой, а каждый вызов бота
+        # ограничен в safe()
+        try:
+            result = await job.prepared
+            if not callable(result):
+                return bool(result)
+            priority.current.set(job.key())
+            retry.budget.set(retry.Budget())
+            return bool(await result())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error publishing message {job.msg.id}: {e}")
+            return False
+
+    async def _run(self, channel):
+        queue = self.queues[channel]
+        try:
+            while queue:
+                self._prefetch(channel)
+                job = min(self._eligible(channel), key=_Job.key)
+                result = await self._publish(job)
+                queue.remove(job)
+                self._account(job)
+                if not job.future.done():
+                    job.future.set_result(result)
+                if config.REQUEST_DELAY:
+                    await asyncio.sleep(config.REQUEST_DELAY)
+        except asyncio.CancelledError:
+            for job in queue:
+                await self._discard(job)
+                job.future.cancel()
+            raise
+        finally:
+            del self.queues[channel]
+            del self.runners[channel]
+            if not self.runners:
+                self.idle.set()
+
+    async def _discard(self, job: _Job):
+        """Снять подготовку сообщения, которое не будет опубликовано, и освободить её файлы"""
+        if job.prepared is None:
+            return
+        job.prepared.cancel()
+        result, = await asyncio.gather(job.prepared, return_exceptions=True)
+        discard = getattr(result, "discard", None)
+        if discard:
+            await discard()
+
+    def _account(self, job: _Job):
+        waited = time.monotonic() - job.since[0]
+        entry = self.latency.setdefault(job.level, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += waited
+        entry[2] = max(entry[2], waited)
+
+    def stats(self) -> str:
+        """Время от постановки до публикации по классам"""
+        return ", ".join(
+            f"{priority.NAMES[level]}: n={n} avg={total / n:.1f}s max={worst:.1f}s"
+            for level, (n, total, worst) in sorted(self.latency.items())
+        ) or "nothing published"
+
+    async def join(self):
+        """Дождаться, пока опустеют очереди всех каналов"""
+        await self.idle.wait()
+
+    async def stop(self):
+        tasks = list(self.runners.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,130 @@
+# app/image_prep.py
+# Пережатие фото перед загрузкой ботом: уменьшение до IMAGE_MAX_SIDE,
+# JPEG с IMAGE_JPEG_QUALITY и, если задан WATERMARK_PATH, водяной знак.
+# Работа с пикселями идёт в ProcessPoolExecutor — цикл asyncio не блокируется.
+# Pillow необязателен: без него этап просто выключен.
+
+import asyncio
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import aiofiles
+from pyrogram.types import Message
+
+from . import config
+from .logger import logger
+from .utils_media import cleanup_files
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+_executor = None
+
+# file_unique_id -> готовые байты; ограничен суммарным размером
+_cache = OrderedDict()
+_cache_bytes = 0
+
+
+def enabled() -> bool:
+    return bool(config.IMAGE_RECOMPRESS and Image is not None)
+
+
+def watermark_enabled() -> bool:
+    return bool(enabled() and config.WATERMARK_PATH)
+
+
+def _recompress(data: bytes, max_side: int, quality: int, watermark_path: str):
+    """Выполняется в дочернем процессе. None — оригинал лучше оставить как есть"""
+    with Image.open(io.BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        if watermark_path:
+            with Image.open(watermark_path) as mark:
+                mark = mark.convert("RGBA")
+                width = max(1, img.width // 5)
+                mark = mark.resize((width, max(1, mark.height * width // mark.width)), Image.LANCZOS)
+                margin = img.width // 50
+                img.paste(mark, (img.width - mark.width - margin, img.height - mark.height - margin), mark)
+
+        out = io.BytesIO()
+        img.save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+
+    result = out.getvalue()
+    if not watermark_path and len(result) >= len(data):
+        return None
+    return result
+
+
+def _cache_put(key, data: bytes):
+    global _cache_bytes
+    old = _cache.pop(key, None)
+    if old is not None:
+        _cache_bytes -= len(old)
+    _cache[key] = data
+    _cache_bytes += len(data)
+    while _cache and _cache_bytes > config.IMAGE_CACHE_MAX_BYTES:
+        _, evicted = _cache.popitem(last=False)
+        _cache_bytes -= len(evicted)
+
+
+async def prepare(msg: Message, media_file):
+    """
+    Пережатое фото вместо media_file (BytesIO или Path); исходник закрывается/удаляется.
+    Видео, выключенный этап и ошибки — возвращается media_file как есть.
+    """
+    global _executor
+    if not enabled() or not msg.photo or not media_file:
+        return media_file
+
+    key = msg.photo.file_unique_id
+    data = _cache.get(key)
+    if data is not None:
+        _cache.move_to_end(key)
+    else:
+        if isinstance(media_file, io.BytesIO):
+            original = media_file.getvalue()
+        else:
+            async with aiofiles.open(media_file, "rb") as f:
+                original = await f.read()
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=config.IMAGE_WORKERS)
+        try:
+            data = await asyncio.get_running_loop().run_in_executor(
+                _executor,
+                _recompress,
+                original,
+                config.IMAGE_MAX_SIDE,
+                config.IMAGE_JPEG_QUALITY,
+                config.WATERMARK_PATH
+            )
+        except Exception as e:
+            logger.warning(f"Image recompression failed for {msg.id}: {e}")
+            return media_file
+        if data is None:
+            return media_file
+        logger.info(f"Photo {msg.id} recompressed: {len(original)} -> {len(data)} bytes")
+        _cache_put(key, data)
+
+    await cleanup_files([media_file])
+    result = io.BytesIO(data)
+    result.name = f"photo_{msg.id}.jpg"
+    return result
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
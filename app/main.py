@@ -6,19 +6,31 @@ import re
 import os
 import sys
 from datetime import datetime
+from functools import partial
 
 from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, InputMediaVideo
 from pyrogram.enums import ParseMode
-from pyrogram.errors import FloodWait, RPCError
+from pyrogram.errors import (
+    Forbidden, ChannelPrivate, ChannelInvalid, PeerIdInvalid, ChatForwardsRestricted, ChatAdminRequired,
+    FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid,
+    MediaEmpty, MediaInvalid, MessageIdInvalid,
+)
 
 from fastapi import FastAPI
 import uvicorn
 
-from . import config, db
+from . import config, db, price_rules, text_cache, backfill, resync, source_state, image_prep, priority, retry
+from .media_cache import media_cache
+from .photo_index import photo_index
+from .albums import AlbumBuffer
 from .logger import logger
-from .utils_price import replace_prices_in_text
-from .utils_media import download_media, cleanup_files
+from .utils_price import replace_prices_by_rules
+from .utils_media import fetch_media, media_file_name, spill_to_disk, upload_arg, cleanup_files
+from .workspace import workspace
+from .dispatcher import Dispatcher
+from .debounce import EditDebouncer
+from .rate_limit import rate_limiter
 
 # ================= FASTAPI =================
 api = FastAPI()
@@ -46,7 +58,8 @@ user_client = Client(
     name=USER_SESSION_PATH,
     api_id=config.API_ID,
     api_hash=config.API_HASH,
-    workdir=BASE_DIR
+    workdir=BASE_DIR,
+    max_concurrent_transmissions=config.DOWNLOAD_CONNECTIONS
 )
 
 BOT_SESSION_PATH = os.path.join(BASE_DIR, config.BOT_SESSION_NAME) if hasattr(config, 'BOT_SESSION_NAME') else None
@@ -56,7 +69,9 @@ bot_client = Client(
     api_id=config.API_ID,
     api_hash=config.API_HASH,
     bot_token=config.BOT_TOKEN if hasattr(config, 'BOT_TOKEN') else None,
-    workdir=BASE_DIR
+    workdir=BASE_DIR,
+    # copy_media_group не принимает parse_mode — подписи разбираются по умолчанию клиента
+    parse_mode=ParseMode.HTML
 )
 
 # ================= REGEX =================
@@ -81,83 +96,341 @@ def clean_text(text: str) -> str:
     text = re.sub(r"\n{3,}", "\n\n", text)
     return text.strip()
 
+def transform_text(raw: str, rules, key=None):
+    """clean_text + замена цен, с кэшем по хэшу сырого текста и версии правил"""
+    key = key or text_cache.make_key(raw, rules.version)
+    cached = text_cache.transform_cache.get(key)
+    if cached is not None:
+        return cached
+
+    new_text, changed = replace_prices_by_rules(clean_text(raw), rules)
+    text_cache.transform_cache.put(key, new_text, changed)
+    return new_text, changed
+
 def build_keyboard():
     return InlineKeyboardMarkup(
         [[InlineKeyboardButton("Заказать", url="https://t.me/linfortepiano")]]
     )
 
+class _OutcomeUnknown:
+    """Исход отправки неизвестен: ложен, как неудача, но загружать заново нельзя"""
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "OUTCOME_UNKNOWN"
+
+OUTCOME_UNKNOWN = _OutcomeUnknown()
+
 async def safe(func, *args, **kwargs):
-    """ИСПРАВЛЕНА: Убрана бесконечность, добавлены таймауты"""
-    max_retries = 3
-    for attempt in range(max_retries):
+    """
+    Вызов бота по политике retry: очередь ведра rate_limit, таймаут попытки,
+    повтор только временных ошибок — с паузой и в пределах бюджета сообщения.
+    None — не удалось, "already_updated" — менять было нечего,
+    OUTCOME_UNKNOWN — таймаут отправки: пост мог выйти, другой способ отправки
+    не пробуем, чтобы не продублировать его.
+    """
+    # лимит по настоящему методу бота, даже если он обёрнут в _reuse_call
+    method = args[0] if func is _reuse_call else func
+    name = method.__name__
+    bucket = rate_limiter.bucket(name, kwargs.get("chat_id"))
+    cost = len(kwargs.get("media") or ()) if isinstance(kwargs.get("media"), list) else 1
+    budget = retry.budget.get() or retry.Budget()
+    attempts = config.MAX_RETRIES
+    attempt = floods = 0
+    while attempt < attempts:
         try:
-            # Таймаут на выполнение функции
-            return await asyncio.wait_for(func(*args, **kwargs), timeout=30.0)
-        except FloodWait as fw:
-            logger.warning(f"FloodWait {fw.value}s, attempt {attempt+1}/{max_retries}")
-            await asyncio.sleep(min(fw.value, 300))
-        except asyncio.TimeoutError:
-            logger.error(f"Timeout on attempt {attempt+1}/{max_retries}")
-            if attempt == max_retries - 1:
-                return None
-            await asyncio.sleep(2 ** attempt)
-        except RPCError as e:
-            if "MESSAGE_NOT_MODIFIED" in str(e):
+            await bucket.acquire(cost)
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout=retry.timeout_for(name))
+            bucket.on_success()
+            return result
+        except Exception as e:
+            action = retry.classify(e, name)
+            if action == retry.DONE:
                 logger.info(f"Message already up to date")
                 return "already_updated"
-            elif "FLOOD_WAIT" in str(e):
-                import re
-                match = re.search(r"FLOOD_WAIT_(\d+)", str(e))
-                wait_time = int(match.group(1)) if match else 60
-                logger.warning(f"Flood wait {wait_time}s")
-                await asyncio.sleep(min(wait_time, 300))
-                continue
-            else:
-                logger.error(f"RPCError on attempt {attempt+1}: {e}")
-                if attempt == max_retries - 1:
-                    return None
-                await asyncio.sleep(2 ** attempt)
-        except Exception as e:
-            logger.error(f"Unexpected error on attempt {attempt+1}: {e}")
-            if attempt == max_retries - 1:
+            if action == retry.FLOOD:
+                wait = e.value if isinstance(getattr(e, "value", None), int) else 60
+                floods += 1
+                logger.warning(f"FloodWait {wait}s on {name}, {floods}/{attempts}")
+                bucket.on_flood(min(wait, 300))
+                if floods < attempts:
+                    # ждём в bucket.acquire следующей попытки — вместе со всеми вызовами
+                    # этого чата; ожидание попыток не тратит
+                    continue
+                logger.error(f"{name} failed after {floods} FloodWaits")
                 return None
-    
-    logger.error(f"Failed after {max_retries} attempts")
+            if action == retry.UNKNOWN:
+                logger.error(f"{name} timed out, the message may have been sent: {e!r}")
+                return OUTCOME_UNKNOWN
+            if action == retry.FATAL:
+                logger.error(f"{name} failed, not retrying: {e!r}")
+                return None
+            attempt += 1
+            if attempt == attempts:
+                break
+            if not budget.take():
+                logger.error(f"{name} failed, retry budget of the message is spent: {e!r}")
+                return None
+            delay = retry.backoff(attempt - 1)
+            logger.warning(f"{name} attempt {attempt}/{attempts} failed: {e!r}, retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    logger.error(f"{name} failed after {attempts} attempts")
     return None
 
+# ================= MEDIA REUSE =================
+_REUSE_DENIED = object()    # нет доступа к каналу-источнику — способ не работает для всего канала
+_REUSE_REJECTED = object()  # не принят этот файл/сообщение — пробуем следующий способ
+
+# ошибки доступа: повторять способ для этого канала бессмысленно
+REUSE_DENIED_ERRORS = (
+    Forbidden, ChannelPrivate, ChannelInvalid, PeerIdInvalid, ChatForwardsRestricted, ChatAdminRequired,
+)
+# ошибки конкретного файла или исходного сообщения
+REUSE_REJECTED_ERRORS = (
+    FileIdInvalid, FileReferenceEmpty, FileReferenceExpired, FileReferenceInvalid,
+    MediaEmpty, MediaInvalid, MessageIdInvalid, ValueError,
+)
+
+# (способ, канал-источник), на которые Telegram ответил отказом доступа в этом запуске
+_reuse_rejected = set()
+
+async def _reuse_call(func, **kwargs):
+    """
+    Отказы переиспользования не ретраим в safe(). Прочие ошибки (например,
+    длинная подпись) уходят в safe() как есть: загрузка заново их не исправит.
+    """
+    try:
+        return await func(**kwargs)
+    except REUSE_DENIED_ERRORS as e:
+        logger.warning(f"Media reuse denied ({func.__name__}): {e}")
+        return _REUSE_DENIED
+    except REUSE_REJECTED_ERRORS as e:
+        logger.warning(f"Media reuse rejected ({func.__name__}): {e}")
+        return _REUSE_REJECTED
+
+async def known_file_id(m: Message, similar: bool = True):
+    """
+    file_id уже загруженного ботом файла: тот же файл (media_cache)
+    или похожее фото (photo_index). (источник, file_id) или (None, None).
+    similar=False — только тот же файл: при замене медиа ближайшее похожее —
+    обычно старое фото этого же поста, и правка вернула бы его.
+    """
+    media = m.photo or m.video
+    file_id = await media_cache.lookup(media.file_unique_id, media.file_size)
+    if file_id:
+        return "cache", file_id
+    if not similar:
+        return None, None
+    file_id = await photo_index.lookup(m)
+    if file_id:
+        return "similar", file_id
+    return None, None
+
+async def forget_file_id(m: Message, source, file_id):
+    """Telegram не принял file_id из known_file_id"""
+    if source == "cache":
+        await media_cache.forget((m.photo or m.video).file_unique_id)
+    elif source == "similar":
+        await photo_index.forget(file_id)
+
+async def send_reused_media(msg: Message, caption: str, kb, known=None):
+    """
+    Опубликовать фото/видео исходника без скачивания и повторной загрузки:
+    уже загруженный ботом файл (тот же или похожее фото) или copy_message
+    с новой подписью. file_id исходника читателя боту не годится — он привязан
+    к получившему его клиенту. None — нужен download + upload; False — ошибка
+    самого сообщения, загрузка заново не поможет; OUTCOME_UNKNOWN — копия могла
+    уже выйти, дальше не пробуем. known — уже найденный known_file_id(msg).
+    """
+    mode = config.MEDIA_REUSE_MODE
+    if msg.photo and image_prep.watermark_enabled():
+        mode = "off"  # копия исходника ушла бы без водяного знака
+    attempts = []
+    source, known_id = known or await known_file_id(msg)
+    if known_id:
+        attempts.append((source, bot_client.send_cached_media, dict(file_id=known_id)))
+    if mode in ("auto", "copy"):
+        attempts.append(("copy", bot_client.copy_message, dict(from_chat_id=msg.chat.id, message_id=msg.id)))
+
+    for method, func, kwargs in attempts:
+        key = (method, msg.chat.id)
+        if key in _reuse_rejected:
+            continue
+
+        sent = await safe(
+            _reuse_call,
+            func,
+            chat_id=config.TARGET_CHANNEL,
+            caption=caption,
+            parse_mode=ParseMode.HTML,
+            reply_markup=kb,
+            **kwargs
+        )
+        if sent is _REUSE_REJECTED:
+            if method == source:
+                await forget_file_id(msg, source, known_id)
+            continue
+        if sent is _REUSE_DENIED:
+            if method != source:
+                _reuse_rejected.add(key)
+                logger.info(f"Media reuse via {method} disabled for {msg.chat.id} until restart")
+            continue
+        if sent is OUTCOME_UNKNOWN:
+            return sent
+        if not sent:
+            return False
+        logger.info(f"Media of message {msg.id} reused via {method}")
+        return sent
+
+    return None
+
+async def replace_target_media(msg: Message, target_id: int, caption: str, kb, known=None, media_file=None):
+    """
+    Источник сменил фото/видео — единственный случай правки, когда файл
+    действительно нужно скачать (если бот его ещё не загружал).
+    known — уже найденный known_file_id(msg, similar=False), media_file — уже
+    скачанный файл. Возвращает (sent, скачанный файл).
+    """
+    input_media = InputMediaPhoto if msg.photo else InputMediaVideo
+
+    source, known_id = known or await known_file_id(msg, similar=False)
+    if known_id:
+        sent = await safe(
+            _reuse_call,
+            bot_client.edit_message_media,
+            chat_id=config.TARGET_CHANNEL,
+            message_id=target_id,
+            media=input_media(known_id, caption=caption, parse_mode=ParseMode.HTML),
+            reply_markup=kb
+        )
+        if sent is _REUSE_REJECTED:
+            await forget_file_id(msg, source, known_id)
+        elif sent is not _REUSE_DENIED:
+            return sent, None
+
+    media_file = media_file or await image_prep.prepare(msg, await fetch_media(msg))
+    if not media_file:
+        return None, None
+    if msg.video:
+        # edit_message_media pyrogram берёт mime и имя видео из пути — BytesIO не примет
+        media_file = await spill_to_disk(msg, media_file)
+
+    sent = await safe(
+        bot_client.edit_message_media,
+        chat_id=config.TARGET_CHANNEL,
+        message_id=target_id,
+        media=input_media(upload_arg(media_file), caption=caption, parse_mode=ParseMode.HTML),
+        reply_markup=kb,
+        # на диске файл назван по file_unique_id — читателю показываем исходное имя
+        file_name=media_file_name(msg)
+    )
+    return sent, media_file
+
+def upload_expected(msg: Message, known_id, editing: bool) -> bool:
+    """
+    Без загрузки файла не обойтись: бот его ещё не загружал, а замена медиа
+    (editing) или все способы переиспользования для канала недоступны
+    """
+    if known_id:
+        return False
+    if editing:
+        return True
+    mode = config.MEDIA_REUSE_MODE
+    if msg.photo and image_prep.watermark_enabled():
+        mode = "off"
+    return mode not in ("auto", "copy") or ("copy", msg.chat.id) in _reuse_rejected
+
 # ================= CORE =================
-async def process_message(msg: Message):
-    raw = (msg.text or "") + (msg.caption or "")
+async def process_message(msg: Message, states=None):
+    """
+    True — сообщение обработано (опубликовано или публиковать нечего), False — сбой.
+    states — заранее выбранные записи db.get_message_states для пачки: по ним
+    без запроса к БД пропускаются неизменённые, остальные читаются заново.
+    """
+    result = await prepare_message(msg, states)
+    return await result() if callable(result) else result
+
+async def prepare_message(msg: Message, states=None):
+    """
+    Всё, что не требует вызовов бота: проверки, преобразование текста, поиск
+    file_id и, если без загрузки файла не обойтись, скачивание медиа.
+    Возвращает bool (публиковать нечего) или async publish() -> bool —
+    публикацию, которую диспетчер запускает строго в порядке канала.
+    """
+    raw = source_state.raw_text(msg)
     logger.info(f"PROCESS {msg.id}")
 
+    # Участник альбома: подпись обычно только у одного, поэтому проверки
+    # делаются для альбома целиком; уже опубликованный и не менявшийся — пропускаем сразу
+    if msg.media_group_id and (msg.photo or msg.video):
+        state = states.get(msg.id) if states is not None else await db.get_message_state(str(msg.chat.id), msg.id)
+        version = source_state.source_version(msg)
+        if source_state.is_unchanged(state, *version):
+            logger.info(f"SKIP {msg.id} (album member not changed)")
+            return True
+        if source_state.is_skipped(state, *version):
+            logger.info(f"SKIP {msg.id} (album already skipped)")
+            return True
+        return lambda: album_buffer.submit(msg)
+
     if not has_date_start(raw):
         logger.info(f"SKIP {msg.id} (no date)")
-        return
-
-    text = clean_text(raw)
-
-    new_text, price_changes = replace_prices_in_text(
-        text=text,
-        pro_delta=config.PRICE_PRO_DELTA,
-        default_delta=config.PRICE_DEFAULT_DELTA,
-        min_zero=config.MIN_PRICE_TO_ZERO,
-        min_ignore=config.MIN_PRICE_TO_IGNORE
-    )
+        return True
+
+    # Таблица правил цен (settings.price_rules), перечитывается на лету
+    await price_rules.reload_rules()
+    rules = source_state.rules_for(msg)
+
+    # Исходник не менялся (та же дата правки и тот же текст при тех же правилах) —
+    # дальше ничего не считаем. Заранее выбранной записи хватает только для этого:
+    # её читали за страницу до публикации, и живой апдейт мог успеть опубликовать
+    # сообщение — без свежей записи оно ушло бы второй раз
+    source_channel = str(msg.chat.id)
+    edit_date, raw_hash = source_state.source_version(msg, rules)
+    if states is not None and source_state.is_unchanged(states.get(msg.id), edit_date, raw_hash):
+        logger.info(f"SKIP {msg.id} (source not changed)")
+        return True
+
+    # Получаем прошлое состояние из базы данных (с учётом ещё не закоммиченных записей)
+    state = await db.get_message_state(source_channel, msg.id)
+    old_target_id = state["target_message_id"] if state else None
+    if source_state.is_unchanged(state, edit_date, raw_hash):
+        logger.info(f"SKIP {msg.id} (source not changed)")
+        return True
+
+    new_text, price_changes = transform_text(raw, rules, key=raw_hash)
 
     if not new_text.strip():
         logger.info(f"SKIP {msg.id} (empty text after cleaning)")
-        return
+        return True
 
-    # Получаем старый текст из базы данных
-    old_target_id, old_text = await db.get_message_target_with_text(str(msg.chat.id), msg.id)
+    fingerprint = text_cache.text_fingerprint(new_text)
+    media = msg.photo or msg.video
+    media_unique_id = media.file_unique_id if media else None
+    message_type = "photo" if msg.photo else "video" if msg.video else "text"
+    media_changed = False
     
     # Логируем изменения
     if old_target_id:
         logger.info(f"Found existing message in DB: target_id={old_target_id}")
+
+        # у старых записей id файла нет — считаем, что медиа не менялось
+        old_media_id = state["media_unique_id"]
+        media_changed = bool(media_unique_id and old_media_id and old_media_id != media_unique_id)
         
-        if old_text == new_text:
+        # summary обрезан до 800 символов — сравниваем по отпечатку полного текста;
+        # для старых записей без отпечатка остаётся сравнение summary
+        old_fingerprint = state["text_fingerprint"]
+        text_same = old_fingerprint == fingerprint or (not old_fingerprint and state["summary"] == new_text)
+        if text_same and not media_changed:
             logger.info(f"SKIP {msg.id} (text not changed)")
-            return
+            await db.update_message_source(source_channel, msg.id, edit_date, raw_hash, media_unique_id)
+            return True
+        elif media_changed:
+            logger.info(f"Media changed for message {msg.id}: {old_media_id} -> {media_unique_id}")
         else:
             logger.info(f"Text changed for message {msg.id}")
             if price_changes:
@@ -166,128 +439,425 @@ async def process_message(msg: Message):
         logger.info(f"New message {msg.id}, no previous record in DB")
 
     kb = build_keyboard()
-    media_file = None
-
-    try:
-        if msg.photo:
-            media_file = await download_media(msg)
-            if old_target_id:
-                logger.info(f"Editing photo message {msg.id} -> {old_target_id}")
-                sent = await safe(
-                    bot_client.edit_message_caption,
-                    chat_id=config.TARGET_CHANNEL,
-                    message_id=old_target_id,
-                    caption=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
-                )
-                if sent and sent != "already_updated":
-                    logger.info(f"✅ Photo message {msg.id} edited successfully")
-                elif sent == "already_updated":
-                    logger.info(f"✅ Photo message {msg.id} already up to date")
-            else:
-                logger.info(f"Sending new photo message {msg.id}")
-                sent = await safe(
-                    bot_client.send_photo,
-                    chat_id=config.TARGET_CHANNEL,
-                    photo=media_file,
-                    caption=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
-                )
-                if sent:
-                    logger.info(f"✅ Photo message {msg.id} sent successfully, target_id={sent.id}")
+    known, media_file = (None, None), None
+    if media and (media_changed or not old_target_id):
+        known = await known_file_id(msg, similar=not old_target_id)
+        if upload_expected(msg, known[1], editing=bool(old_target_id)):
+            # файл точно придётся загружать — качаем сейчас, пока публикация
+            # предыдущих сообщений канала, возможно, ждёт окончания FloodWait
+            try:
+                media_file = await fetch_media(msg)
+                media_file = await image_prep.prepare(msg, media_file)
+            except BaseException:
+                # таймаут или отмена подготовки — файл и квота не должны зависнуть
+                await cleanup_files([media_file])
+                raise
+
+    async def publish():
+        nonlocal media_file
+        try:
+            if msg.photo:
+                if old_target_id and media_changed:
+                    logger.info(f"Replacing photo of message {msg.id} -> {old_target_id}")
+                    sent, media_file = await replace_target_media(msg, old_target_id, new_text, kb, known, media_file)
+                    if sent and sent != "already_updated":
+                        logger.info(f"✅ Photo message {msg.id} replaced successfully")
+                elif old_target_id:
+                    # только подпись — файл не нужен
+                    logger.info(f"Editing photo message {msg.id} -> {old_target_id}")
+                    sent = await safe(
+                        bot_client.edit_message_caption,
+                        chat_id=config.TARGET_CHANNEL,
+                        message_id=old_target_id,
+                        caption=new_text,
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=kb
+                    )
+                    if sent and sent != "already_updated":
+                        logger.info(f"✅ Photo message {msg.id} edited successfully")
+                    elif sent == "already_updated":
+                        logger.info(f"✅ Photo message {msg.id} already up to date")
+                else:
+                    logger.info(f"Sending new photo message {msg.id}")
+                    sent = await send_reused_media(msg, new_text, kb, known)
+                    if sent is None:
+                        # переиспользовать не дали — перекачиваем (в памяти) и загружаем заново
+                        media_file = media_file or await image_prep.prepare(msg, await fetch_media(msg))
+                        sent = await safe(
+                            bot_client.send_photo,
+                            chat_id=config.TARGET_CHANNEL,
+                            photo=upload_arg(media_file),
+                            caption=new_text,
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=kb
+                        )
+                    if sent:
+                        logger.info(f"✅ Photo message {msg.id} sent successfully, target_id={sent.id}")
                 
-        elif msg.video:
-            media_file = await download_media(msg)
-            if old_target_id:
-                logger.info(f"Editing video message {msg.id} -> {old_target_id}")
-                sent = await safe(
-                    bot_client.edit_message_caption,
-                    chat_id=config.TARGET_CHANNEL,
-                    message_id=old_target_id,
-                    caption=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
-                )
-                if sent and sent != "already_updated":
-                    logger.info(f"✅ Video message {msg.id} edited successfully")
-                elif sent == "already_updated":
-                    logger.info(f"✅ Video message {msg.id} already up to date")
+            elif msg.video:
+                if old_target_id and media_changed:
+                    logger.info(f"Replacing video of message {msg.id} -> {old_target_id}")
+                    sent, media_file = await replace_target_media(msg, old_target_id, new_text, kb, known, media_file)
+                    if sent and sent != "already_updated":
+                        logger.info(f"✅ Video message {msg.id} replaced successfully")
+                elif old_target_id:
+                    # только подпись — файл не нужен
+                    logger.info(f"Editing video message {msg.id} -> {old_target_id}")
+                    sent = await safe(
+                        bot_client.edit_message_caption,
+                        chat_id=config.TARGET_CHANNEL,
+                        message_id=old_target_id,
+                        caption=new_text,
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=kb
+                    )
+                    if sent and sent != "already_updated":
+                        logger.info(f"✅ Video message {msg.id} edited successfully")
+                    elif sent == "already_updated":
+                        logger.info(f"✅ Video message {msg.id} already up to date")
+                else:
+                    logger.info(f"Sending new video message {msg.id}")
+                    sent = await send_reused_media(msg, new_text, kb, known)
+                    if sent is None:
+                        # переиспользовать не дали — перекачиваем (в памяти) и загружаем заново
+                        media_file = media_file or await fetch_media(msg)
+                        sent = await safe(
+                            bot_client.send_video,
+                            chat_id=config.TARGET_CHANNEL,
+                            video=upload_arg(media_file),
+                            file_name=media_file_name(msg),
+                            caption=new_text,
+                            parse_mode=ParseMode.HTML,
+                            reply_markup=kb
+                        )
+                    if sent:
+                        logger.info(f"✅ Video message {msg.id} sent successfully, target_id={sent.id}")
             else:
-                logger.info(f"Sending new video message {msg.id}")
-                sent = await safe(
-                    bot_client.send_video,
-                    chat_id=config.TARGET_CHANNEL,
-                    video=media_file,
-                    caption=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
+                if old_target_id:
+                    logger.info(f"Editing text message {msg.id} -> {old_target_id}")
+                    sent = await safe(
+                        bot_client.edit_message_text,
+                        chat_id=config.TARGET_CHANNEL,
+                        message_id=old_target_id,
+                        text=new_text,
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=kb
+                    )
+                    if sent and sent != "already_updated":
+                        logger.info(f"✅ Text message {msg.id} edited successfully")
+                    elif sent == "already_updated":
+                        logger.info(f"✅ Text message {msg.id} already up to date")
+                else:
+                    logger.info(f"Sending new text message {msg.id}")
+                    sent = await safe(
+                        bot_client.send_message,
+                        chat_id=config.TARGET_CHANNEL,
+                        text=new_text,
+                        parse_mode=ParseMode.HTML,
+                        reply_markup=kb
+                    )
+                    if sent:
+                        logger.info(f"✅ Text message {msg.id} sent successfully, target_id={sent.id}")
+
+            # Обновляем базу данных
+            if sent and sent != "already_updated":
+                await db.update_message_target(
+                    source_channel,
+                    msg.id,
+                    sent.id,
+                    datetime.utcnow().isoformat(),
+                    new_text[:800],
+                    message_type,
+                    text_fingerprint=fingerprint,
+                    source_edit_date=edit_date,
+                    raw_hash=raw_hash,
+                    media_unique_id=media_unique_id
                 )
-                if sent:
-                    logger.info(f"✅ Video message {msg.id} sent successfully, target_id={sent.id}")
-        else:
-            if old_target_id:
-                logger.info(f"Editing text message {msg.id} -> {old_target_id}")
-                sent = await safe(
-                    bot_client.edit_message_text,
-                    chat_id=config.TARGET_CHANNEL,
-                    message_id=old_target_id,
-                    text=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
+                logger.info(f"✅ Database updated for message {msg.id}")
+                await media_cache.remember(media_unique_id, sent)
+                await photo_index.remember(msg, sent)
+            elif sent == "already_updated" and old_target_id:
+                await db.update_message_target(
+                    source_channel,
+                    msg.id,
+                    old_target_id,
+                    datetime.utcnow().isoformat(),
+                    new_text[:800],
+                    message_type,
+                    text_fingerprint=fingerprint,
+                    source_edit_date=edit_date,
+                    raw_hash=raw_hash,
+                    media_unique_id=media_unique_id
                 )
-                if sent and sent != "already_updated":
-                    logger.info(f"✅ Text message {msg.id} edited successfully")
-                elif sent == "already_updated":
-                    logger.info(f"✅ Text message {msg.id} already up to date")
-            else:
-                logger.info(f"Sending new text message {msg.id}")
-                sent = await safe(
-                    bot_client.send_message,
-                    chat_id=config.TARGET_CHANNEL,
-                    text=new_text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=kb
+                logger.info(f"✅ Database timestamp updated for message {msg.id}")
+
+            return bool(sent)
+
+        except Exception as e:
+            logger.error(f"❌ Error processing message {msg.id}: {str(e)}")
+            logger.error(traceback.format_exc())
+            return False
+        finally:
+            if media_file:
+                await cleanup_files([media_file])
+
+    async def discard():
+        """Публикация не состоится — освободить заранее скачанный файл"""
+        await cleanup_files([media_file])
+
+    publish.discard = discard
+    # класс для диспетчера: правка цен важнее косметической
+    publish.priority = (
+        priority.NEW if not old_target_id
+        else priority.PRICE_EDIT if price_changes
+        else priority.EDIT
+    )
+    return publish
+
+# ================= ALBUMS =================
+async def _album_input_media(m: Message, caption: str):
+    """InputMedia участника: уже загруженный ботом файл или скачанный; (media, файл для очистки)"""
+    input_media = InputMediaPhoto if m.photo else InputMediaVideo
+
+    _, known_id = await known_file_id(m)
+    if known_id:
+        return input_media(known_id, caption=caption, parse_mode=ParseMode.HTML), None
+
+    media_file = await image_prep.prepare(m, await fetch_media(m))
+    if not media_file:
+        return None, None
+    return input_media(upload_arg(media_file), caption=caption, parse_mode=ParseMode.HTML), media_file
+
+async def send_album(members, caption: str, media_files: list):
+    """Новый альбом одним вызовом: {id участника: отправленное сообщение} или None"""
+    key = ("copy", members[0].chat.id)
+    watermark = image_prep.watermark_enabled() and any(m.photo for m in members)
+    if config.MEDIA_REUSE_MODE in ("auto", "copy") and key not in _reuse_rejected and not watermark:
+        sent = await safe(
+            _reuse_call,
+            bot_client.copy_media_group,
+            chat_id=config.TARGET_CHANNEL,
+            from_chat_id=members[0].chat.id,
+            message_id=members[0].id,
+            captions=caption
+        )
+        if sent is _REUSE_DENIED:
+            _reuse_rejected.add(key)
+            logger.info(f"Media reuse via copy disabled for {members[0].chat.id} until restart")
+        elif sent is _REUSE_REJECTED:
+            pass  # этот альбом — загрузкой заново
+        elif not sent:
+            # в т.ч. OUTCOME_UNKNOWN: копия могла выйти, загрузка её продублирует
+            return None
+        else:
+            # альбом уже опубликован: загружать заново — значит продублировать его.
+            # Копии идут в порядке исходника; участники — только фото и видео
+            copies = [s for s in sent if s.photo or s.video]
+            if len(copies) != len(members):
+                logger.warning(
+                    f"Album {members[0].media_group_id}: copied {len(copies)} of {len(members)} items"
                 )
-                if sent:
-                    logger.info(f"✅ Text message {msg.id} sent successfully, target_id={sent.id}")
+            logger.info(f"Album {members[0].media_group_id} reused via copy")
+            return dict(zip((m.id for m in members), copies))
+
+    # подпись — только у первого участника; файлы качаются параллельно
+    prepared = await asyncio.gather(*(
+        _album_input_media(m, caption if i == 0 else "") for i, m in enumerate(members)
+    ))
+    media_files.extend(f for _, f in prepared if f)
+    if not all(media for media, _ in prepared):
+        logger.error(f"❌ Album {members[0].media_group_id}: media download failed")
+        return None
+
+    sent = await safe(bot_client.send_media_group, chat_id=config.TARGET_CHANNEL, media=[media for media, _ in prepared])
+    if not sent:
+        return None
+    if len(sent) != len(members):
+        logger.warning(f"Album {members[0].media_group_id}: sent {len(sent)} of {len(members)} items")
+    return dict(zip((m.id for m in members), sent))
+
+async def edit_album(members, states, caption: str, text_changed: bool, media_files: list):
+    """
+    Правка опубликованного альбома по участникам: замена изменившихся файлов
+    и подписи у первого. {id участника: target_id} для записи в БД или None.
+    """
+    targets = {
+        m.id: states[m.id]["target_message_id"]
+        for m in members if states.get(m.id) and states[m.id]["target_message_id"]
+    }
+    caption_target = targets.get(members[0].id)
+    caption_done = False
+
+    for i, m in enumerate(members):
+        target_id = targets.get(m.id)
+        if not target_id:
+            # в опубликованный альбом новое фото не добавить
+            logger.warning(f"Album member {m.id} has no target, skipping")
+            continue
+
+        old_media_id = states[m.id]["media_unique_id"]
+        media_unique_id = (m.photo or m.video).file_unique_id
+        if old_media_id and old_media_id != media_unique_id:
+            logger.info(f"Replacing album media {m.id} -> {target_id}")
+            sent, media_file = await replace_target_media(m, target_id, caption if i == 0 else "", None)
+            if media_file:
+                media_files.append(media_file)
+            if not sent:
+                return None
+            caption_done = caption_done or target_id == caption_target
+
+    if text_changed and caption_target and not caption_done:
+        logger.info(f"Editing album caption {members[0].id} -> {caption_target}")
+        sent = await safe(
+            bot_client.edit_message_caption,
+            chat_id=config.TARGET_CHANNEL,
+            message_id=caption_target,
+            caption=caption,
+            parse_mode=ParseMode.HTML
+        )
+        if not sent:
+            return None
+
+    return targets
+
+async def process_album(msg: Message):
+    """
+    Альбом целиком: один send_media_group (или copy_media_group), правки — по участникам.
+    (итог, участники) — итог получат и остальные участники (AlbumBuffer).
+    """
+    try:
+        members = await user_client.get_media_group(msg.chat.id, msg.id)
+    except ValueError:
+        members = [msg]
+    members = sorted((m for m in members if m.photo or m.video), key=lambda m: m.id)
+    group_id = msg.media_group_id
+    logger.info(f"PROCESS album {group_id}: {[m.id for m in members]}")
+
+    raw = "".join(source_state.raw_text(m) for m in members)
+    await price_rules.reload_rules()
+    rules = source_state.rules_for(msg)
+    source_channel = str(msg.chat.id)
+    versions = {m.id: source_state.source_version(m, rules) for m in members}
 
-        # Обновляем базу данных
-        if sent and sent != "already_updated":
-            await db.update_message_target(
-                str(msg.chat.id),
-                msg.id,
-                sent.id,
-                datetime.utcnow().isoformat(),
-                new_text[:800]
-            )
-            logger.info(f"✅ Database updated for message {msg.id}")
-        elif sent == "already_updated" and old_target_id:
+    if not has_date_start(raw):
+        logger.info(f"SKIP album {group_id} (no date)")
+        await mark_album_skipped(source_channel, members, versions)
+        return True, members
+
+    states = await db.get_message_states(source_channel, [m.id for m in members])
+    if all(source_state.is_unchanged(states.get(m.id), *versions[m.id]) for m in members):
+        logger.info(f"SKIP album {group_id} (source not changed)")
+        return True, members
+
+    new_text, price_changes = transform_text(raw, rules)
+    if not new_text.strip():
+        logger.info(f"SKIP album {group_id} (empty text after cleaning)")
+        if not any(states.get(m.id) and states[m.id]["target_message_id"] for m in members):
+            await mark_album_skipped(source_channel, members, versions)
+        return True, members
+
+    fingerprint = text_cache.text_fingerprint(new_text)
+    head_state = states.get(members[0].id)
+    published = any(states.get(m.id) and states[m.id]["target_message_id"] for m in members)
+    media_files = []
+
+    try:
+        if published:
+            old_fingerprint = head_state["text_fingerprint"] if head_state else None
+            text_changed = old_fingerprint != fingerprint
+            if text_changed and price_changes:
+                logger.info(f"Price changes detected: {price_changes}")
+            targets = await edit_album(members, states, new_text, text_changed, media_files)
+        else:
+            logger.info(f"Sending new album {group_id} ({len(members)} items)")
+            sent = await send_album(members, new_text, media_files)
+            targets = {m_id: s.id for m_id, s in sent.items()} if sent else None
+            for m in members:
+                if sent and m.id in sent:
+                    await media_cache.remember((m.photo or m.video).file_unique_id, sent[m.id])
+                    await photo_index.remember(m, sent[m.id])
+
+        if targets is None:
+            return False, members
+
+        processed_at = datetime.utcnow().isoformat()
+        for m in members:
+            if m.id not in targets:
+                continue
+            edit_date, raw_hash = versions[m.id]
             await db.update_message_target(
-                str(msg.chat.id),
-                msg.id,
-                old_target_id,
-                datetime.utcnow().isoformat(),
-                new_text[:800]
+                source_channel,
+                m.id,
+                targets[m.id],
+                processed_at,
+                new_text[:800],
+                "photo" if m.photo else "video",
+                text_fingerprint=fingerprint,
+                source_edit_date=edit_date,
+                raw_hash=raw_hash,
+                media_unique_id=(m.photo or m.video).file_unique_id
             )
-            logger.info(f"✅ Database timestamp updated for message {msg.id}")
-
-    except Exception as e:
-        logger.error(f"❌ Error processing message {msg.id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.info(f"✅ Album {group_id} processed, targets={list(targets.values())}")
+        return True, members
     finally:
-        if media_file:
-            cleanup_files([media_file])
+        await cleanup_files(media_files)
+
+async def mark_album_skipped(source_channel: str, members, versions: dict):
+    """
+    Запись без target_message_id: следующий запуск пропустит неизменённых
+    участников без get_media_group (source_state.is_skipped)
+    """
+    processed_at = datetime.utcnow().isoformat()
+    for m in members:
+        edit_date, raw_hash = versions[m.id]
+        await db.update_message_target(
+            source_channel,
+            m.id,
+            None,
+            processed_at,
+            "",
+            "photo" if m.photo else "video",
+            source_edit_date=edit_date,
+            raw_hash=raw_hash,
+            media_unique_id=(m.photo or m.video).file_unique_id
+        )
+
+album_buffer = AlbumBuffer(process_album)
+
+# Каналы параллельно, внутри канала — по порядку; общий для апдейтов и backfill
+dispatcher = Dispatcher(prepare_message, config.DISPATCH_WORKERS)
+
+# серия правок одного сообщения -> одна обработка последней версии
+edit_debouncer = EditDebouncer(partial(dispatcher.submit, level=priority.EDIT))
 
 # ================= HANDLERS =================
 @user_client.on_message(filters.chat(config.SOURCE_CHANNELS))
 async def on_new(_, msg: Message):
-    await process_message(msg)
+    dispatcher.submit(msg, level=priority.NEW)
 
 @user_client.on_edited_message(filters.chat(config.SOURCE_CHANNELS))
 async def on_edit(_, msg: Message):
-    await process_message(msg)
+    edit_debouncer.submit(msg)
+
+async def sync_channel(src):
+    logger.info(f"{config.RUN_MODE.upper()} {src}")
+
+    def submit(msg: Message, states):
+        # перепроверки истории уступают живым постам и правкам; ещё не
+        # опубликованное — такой же новый пост и идёт с ними по порядку id
+        state = states.get(msg.id)
+        level = priority.BACKFILL if state and state["target_message_id"] else priority.NEW
+        return dispatcher.submit(msg, states, level=level)
+
+    try:
+        if config.RUN_MODE == "resync":
+            await resync.resync_channel(user_client, src, submit)
+        else:
+            await backfill.backfill_channel(user_client, src, submit)
+    except asyncio.TimeoutError:
+        logger.error(f"Timeout getting history from {src}, moving to next channel")
+    except Exception as e:
+        logger.error(f"Error processing channel {src}: {e}")
 
 # ================= START =================
 async def main():
@@ -295,88 +865,73 @@ async def main():
     
     # Инициализируем БД (она сама создастся если нужно)
     await db.init_db()
+    try:
+        await price_rules.reload_rules(force=True)
+        await text_cache.load()
+        await photo_index.load()
+        await rate_limiter.load()
+        await workspace.start()
     
-    print("[DEBUG] Starting user_client...")
-    await user_client.start()
-    print("[DEBUG] User client started successfully!")
+        print("[DEBUG] Starting user_client...")
+        await user_client.start()
+        print("[DEBUG] User client started successfully!")
     
-    print("[DEBUG] Starting bot_client...")
-    await bot_client.start()
-    print("[DEBUG] Bot client started successfully!")
+        print("[DEBUG] Starting bot_client...")
+        await bot_client.start()
+        print("[DEBUG] Bot client started successfully!")
 
-    # BACKFILL С ПРАВИЛЬНЫМ ПОРЯДКОМ (РЕВЕРС)
-    try:
-        for src in config.SOURCE_CHANNELS:
-            logger.info(f"BACKFILL {src}")
-            message_count = 0
-            
-            try:
-                # Собираем сообщения в список
-                messages = []
-                async for m in user_client.get_chat_history(src, limit=config.BACKFILL_LIMIT):
-                    messages.append(m)
-                    message_count += 1
-                    if message_count >= config.BACKFILL_LIMIT:
-                        break
-                
-                logger.info(f"Collected {len(messages)} messages from {src}")
-                
-                # РЕВЕРСИРУЕМ ПОРЯДОК: старые сообщения → новые
-                messages.reverse()
-                logger.info(f"Reversed order: processing from oldest to newest")
-                
-                # Обрабатываем в правильном порядке (от старых к новым)
-                for i, m in enumerate(messages, 1):
-                    logger.info(f"Processing {i}/{len(messages)} (message ID: {m.id})")
-                    
-                    try:
-                        await asyncio.wait_for(
-                            process_message(m), 
-                            timeout=60.0
-                        )
-                    except asyncio.TimeoutError:
-                        logger.error(f"Timeout processing message {m.id}, skipping")
-                    
-                    await asyncio.sleep(float(config.REQUEST_DELAY))
-                    
-                logger.info(f"✅ Processed {len(messages)} messages from {src} in correct order")
-                
-            except asyncio.TimeoutError:
-                logger.error(f"Timeout getting history from {src}, moving to next channel")
-                continue
-            except Exception as e:
-                logger.error(f"Error processing channel {src}: {e}")
-                continue
-                
-    except asyncio.CancelledError:
-        logger.warning("Backfill cancelled")
-    except Exception as e:
-        logger.error(f"Critical error in backfill: {e}")
+        # BACKFILL: потоково, от старых к новым (или RESYNC уже опубликованного),
+        # все каналы одновременно
+        try:
+            await asyncio.gather(*(sync_channel(src) for src in config.SOURCE_CHANNELS))
+            edit_debouncer.flush()
+            await dispatcher.join()
+        except asyncio.CancelledError:
+            logger.warning("Backfill cancelled")
+        except Exception as e:
+            logger.error(f"Critical error in backfill: {e}")
 
-    logger.info("✅ Bot work completed successfully")
-    
-    # Останавливаем клиенты
-    try:
-        if bot_client.is_connected:
-            await bot_client.stop()
-            print("✅ Bot client stopped")
-    except Exception as e:
-        print(f"⚠️ Bot client stop error: {e}")
+        await dispatcher.stop()
+        logger.info("✅ Bot work completed successfully")
     
-    try:
-        if user_client.is_connected:
-            await user_client.stop()
-            print("✅ User client stopped")
-    except Exception as e:
-        print(f"⚠️ User client stop error: {e}")
+        # Останавливаем клиенты
+        try:
+            if bot_client.is_connected:
+                await bot_client.stop()
+                print("✅ Bot client stopped")
+        except Exception as e:
+            print(f"⚠️ Bot client stop error: {e}")
     
-    # Закрываем БД
-    try:
-        await db.close_db()
-        print("✅ Database closed")
-    except Exception as e:
-        print(f"⚠️ Database close error: {e}")
+        try:
+            if user_client.is_connected:
+                await user_client.stop()
+                print("✅ User client stopped")
+        except Exception as e:
+            print(f"⚠️ User client stop error: {e}")
     
+        logger.info(f"Transform cache: {text_cache.transform_cache.stats()}")
+        logger.info(f"Media cache: {media_cache.stats()}")
+        logger.info(f"Photo index: {photo_index.stats()}")
+        logger.info(f"Edit debounce: {edit_debouncer.stats()}")
+        logger.info(f"Time to publish: {dispatcher.stats()}")
+        image_prep.shutdown()
+        await workspace.close()
+
+        logger.info(f"Rate limits: {rate_limiter.stats()}")
+    finally:
+        # Закрываем БД при любом исходе: без close_db записанное этим запуском
+        # (и опубликованное) не дойдёт до reposter.db, а поток aiosqlite не даст процессу выйти
+        try:
+            await rate_limiter.save()
+            await text_cache.save()
+        except Exception as e:
+            print(f"⚠️ State save error: {e}")
+        try:
+            await db.close_db()
+            print("✅ Database closed")
+        except Exception as e:
+            print(f"⚠️ Database close error: {e}")
+
     print("🎉 Bot finished")
 
 def run_bot():
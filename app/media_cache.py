@@ -0,0 +1,71 @@
+# app/media_cache.py
+# Поставщики повторяют одни и те же фото в разных постах и каналах.
+# Исходный file_unique_id -> file_id файла, уже загруженного ботом:
+# повтор уходит через send_cached_media, без скачивания и загрузки.
+
+import time
+
+from pyrogram.types import Message
+
+from . import config, db
+from .logger import logger
+
+
+class MediaCache:
+    """Таблица media_cache в reposter.db + счётчики попаданий за запуск"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # таблица подрезается раз в столько новых записей, а не на каждой
+        self.prune_every = max(100, max_entries // 10)
+        self.added = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    async def lookup(self, unique_id, file_size=0):
+        """file_id бота для этого файла или None"""
+        if not self.enabled or not unique_id:
+            return None
+
+        file_id = await db.get_cached_file_id(unique_id)
+        if file_id is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += file_size or 0
+        await db.touch_cached_file(unique_id, time.time())
+        return file_id
+
+    async def remember(self, unique_id, sent: Message):
+        """Запомнить file_id из только что опубликованного ботом сообщения"""
+        if not self.enabled or not unique_id or not isinstance(sent, Message):
+            return
+        media = sent.photo or sent.video
+        if not media:
+            return
+        await db.put_cached_file(unique_id, media.file_id, time.time())
+        self.added += 1
+        if self.added % self.prune_every == 0:
+            await db.prune_media_cache(self.max_entries)
+
+    async def forget(self, unique_id):
+        """file_id больше не принимается Telegram"""
+        logger.warning(f"Media cache entry {unique_id} rejected, dropping")
+        await db.delete_cached_file(unique_id)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (
+            f"hits={self.hits} misses={self.misses} ({rate:.0f}%) "
+            f"saved={self.bytes_saved / 1024 / 1024:.1f}MB"
+        )
+
+
+media_cache = MediaCache(config.MEDIA_CACHE_SIZE)
@@ -0,0 +1,156 @@
+# app/photo_index.py
+# Одинаковые товарные фото разные поставщики загружают разными файлами —
+# file_unique_id их не ловит. Для каждого фото считаем dHash (64 бита)
+# по маленькой превьюшке, храним в photo_hashes и ищем соседей
+# по расстоянию Хэмминга через BK-дерево в памяти.
+# Найденное похожее фото отправляется по file_id бота, без загрузки.
+
+import asyncio
+import io
+import time
+
+from pyrogram.types import Message
+
+from . import config, db
+from .logger import logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def dhash(data: bytes) -> int:
+    """Разностный хэш: 8x8 сравнений соседних пикселей по яркости"""
+    with Image.open(io.BytesIO(data)) as img:
+        pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def to_signed(value: int) -> int:
+    """64-битный хэш в диапазон INTEGER SQLite"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """Узел — [хэш, значение, {расстояние: потомок}]"""
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value_hash: int, value):
+        if self.root is None:
+            self.root = [value_hash, value, {}]
+            self.size = 1
+            return
+        node = self.root
+        while True:
+            d = distance(value_hash, node[0])
+            if d == 0:
+                node[1] = value
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value_hash, value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def nearest(self, value_hash: int, max_distance: int):
+        """(расстояние, значение) ближайшего в пределах max_distance или None"""
+        best = None
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = distance(value_hash, node[0])
+            if d <= max_distance and (best is None or d < best[0]):
+                best = (d, node[1])
+            # неравенство треугольника: дальше смотреть только в этих ветках
+            for edge, child in node[2].items():
+                if d - max_distance <= edge <= d + max_distance:
+                    stack.append(child)
+        return best
+
+
+class PhotoIndex:
+    def __init__(self):
+        self.tree = BKTree()
+        self.dead = set()     # file_id, которые Telegram больше не принимает
+        self.hashes = {}      # file_unique_id -> dHash, посчитанные в этом запуске
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(config.PHASH_DEDUPE and Image is not None)
+
+    async def load(self):
+        if not self.enabled:
+            return
+        rows = await db.load_photo_hashes(config.PHASH_INDEX_SIZE)
+        for value_hash, file_id in rows:
+            self.tree.add(value_hash & ((1 << 64) - 1), file_id)
+        logger.info(f"Photo index loaded: {self.tree.size} hashes")
+
+    async def hash_of(self, msg: Message):
+        """dHash фото по самой маленькой превьюшке (без скачивания оригинала)"""
+        key = msg.photo.file_unique_id
+        if key in self.hashes:
+            return self.hashes[key]
+        if not msg.photo.thumbs:
+            return None
+        thumb = min(msg.photo.thumbs, key=lambda t: t.width * t.height)
+        try:
+            data = await msg._client.download_media(thumb.file_id, in_memory=True)
+            value = await asyncio.to_thread(dhash, data.getvalue())
+        except Exception as e:
+            logger.warning(f"Photo hash failed for {msg.id}: {e}")
+            return None
+        self.hashes[key] = value
+        return value
+
+    async def lookup(self, msg: Message):
+        """file_id бота для похожего фото или None"""
+        if not self.enabled or not msg.photo:
+            return None
+
+        value = await self.hash_of(msg)
+        found = self.tree.nearest(value, config.PHASH_MAX_DISTANCE) if value is not None else None
+        if not found or found[1] in self.dead:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        logger.info(f"Photo {msg.id} matches an uploaded one (distance {found[0]})")
+        return found[1]
+
+    async def remember(self, msg: Message, sent: Message):
+        if not self.enabled or not msg.photo or not isinstance(sent, Message) or not sent.photo:
+            return
+        value = self.hashes.get(msg.photo.file_unique_id)
+        if value is None:
+            return
+        self.tree.add(value, sent.photo.file_id)
+        await db.put_photo_hash(msg.photo.file_unique_id, to_signed(value), sent.photo.file_id, time.time())
+
+    async def forget(self, file_id):
+        logger.warning(f"Photo index entry {file_id} rejected, dropping")
+        self.dead.add(file_id)
+        await db.delete_photo_hashes(file_id)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return f"hits={self.hits} misses={self.misses} ({rate:.0f}%) size={self.tree.size}"
+
+
+photo_index = PhotoIndex()
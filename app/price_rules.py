@@ -0,0 +1,226 @@
+# app/price_rules.py
+# Таблица правил цен: какая дельта вычитается из цен строки прайса.
+#
+# Формат (settings, ключ "price_rules", JSON):
+# {
+#   "default_delta": 1000,
+#   "min_price_to_ignore": 10000,
+#   "rules": [
+#     {"match": "pro max", "delta": 3000},
+#     {"match": "pro", "delta": 2000},
+#     {"match": "samsung", "delta": 500, "channels": ["-1001234567890", "@supplier"]},
+#     {"match": "*", "delta": 1500, "channels": ["@supplier"]}
+#   ]
+# }
+#
+# match — слова подряд ("pro max"), регистр не важен; "*" — дельта по умолчанию.
+# Если в строке сработало несколько правил, побеждает:
+# больший priority → правило канала → более длинная фраза → раньше в таблице.
+
+import hashlib
+import json
+import re
+import time
+from dataclasses import dataclass
+
+from . import config, db
+from .logger import logger
+
+SETTINGS_KEY = "price_rules"
+DEFAULT_MATCH = "*"
+
+WORD_RE = re.compile(r"\w+")
+
+
+@dataclass(frozen=True)
+class PriceRule:
+    match: str
+    delta: float
+    channels: tuple = ()
+    priority: int = 0
+
+
+def _normalize_channel(channel) -> str:
+    return str(channel).strip().lstrip("@").lower()
+
+
+class ChannelPriceRules:
+    """
+    Правила, собранные для одного канала.
+    Фразы лежат в dict по кортежу слов, поэтому строка проверяется
+    за O(слов * длина самой длинной фразы) — от числа правил не зависит.
+    """
+
+    def __init__(self, rules, default_delta, min_zero, min_ignore):
+        self.min_zero = min_zero
+        self.min_ignore = min_ignore
+        self.default_delta = default_delta
+
+        best = {}  # фраза -> (rank, delta)
+        for index, (rule, channel_specific) in enumerate(rules):
+            words = tuple(WORD_RE.findall(rule.match.lower()))
+            rank = (rule.priority, channel_specific, len(words), -index)
+            key = DEFAULT_MATCH if rule.match.strip() == DEFAULT_MATCH else words
+            if not key:
+                continue
+            if key not in best or best[key][0] < rank:
+                best[key] = (rank, rule.delta)
+
+        default = best.pop(DEFAULT_MATCH, None)
+        if default:
+            self.default_delta = default[1]
+
+        self.phrases = best
+        self.max_words = max((len(k) for k in best), default=0)
+
+        # отпечаток итоговых правил: одинаковые таблицы разных каналов совпадают
+        signature = repr((
+            sorted((k, v[1]) for k, v in best.items()),
+            self.default_delta, self.min_zero, self.min_ignore
+        ))
+        self.version = hashlib.sha1(signature.encode()).hexdigest()[:12]
+
+    def delta_for(self, line: str):
+        """Дельта для строки прайса (регистр не важен)"""
+        if not self.phrases:
+            return self.default_delta
+
+        words = [w.lower() for w in WORD_RE.findall(line)]
+        phrases = self.phrases
+        found = None
+
+        for i in range(len(words)):
+            for n in range(1, min(self.max_words, len(words) - i) + 1):
+                hit = phrases.get(tuple(words[i:i + n]))
+                if hit and (found is None or found[0] < hit[0]):
+                    found = hit
+
+        return found[1] if found else self.default_delta
+
+
+class PriceRules:
+    """Вся таблица; правила для канала компилируются один раз и кэшируются"""
+
+    def __init__(self, rules, default_delta, min_zero, min_ignore):
+        self.rules = list(rules)
+        self.default_delta = default_delta
+        self.min_zero = min_zero
+        self.min_ignore = min_ignore
+        self.version = hashlib.sha1(
+            json.dumps(self.to_dict(), sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()[:12]
+        self._by_channel = {}
+
+    def to_dict(self):
+        return {
+            "default_delta": self.default_delta,
+            "min_price_to_zero": self.min_zero,
+            "min_price_to_ignore": self.min_ignore,
+            "rules": [
+                {
+                    "match": r.match,
+                    "delta": r.delta,
+                    "channels": list(r.channels),
+                    "priority": r.priority,
+                }
+                for r in self.rules
+            ],
+        }
+
+    def for_channel(self, chat_id=None, username=None) -> ChannelPriceRules:
+        key = (str(chat_id) if chat_id is not None else None, username)
+        compiled = self._by_channel.get(key)
+        if compiled is None:
+            names = {_normalize_channel(k) for k in key if k}
+            selected = []
+            for rule in self.rules:
+                if not rule.channels:
+                    selected.append((rule, False))
+                elif names & {_normalize_channel(c) for c in rule.channels}:
+                    selected.append((rule, True))
+            compiled = ChannelPriceRules(
+                selected, self.default_delta, self.min_zero, self.min_ignore
+            )
+            self._by_channel[key] = compiled
+        return compiled
+
+
+def default_rules(pro_delta=None, default_delta=None) -> PriceRules:
+    """Старое поведение: Pro / Pro Max → PRICE_PRO_DELTA, остальное → PRICE_DEFAULT_DELTA"""
+    pro_delta = config.PRICE_PRO_DELTA if pro_delta is None else pro_delta
+    default_delta = config.PRICE_DEFAULT_DELTA if default_delta is None else default_delta
+    return PriceRules(
+        [PriceRule("pro max", pro_delta), PriceRule("pro", pro_delta)],
+        default_delta,
+        config.MIN_PRICE_TO_ZERO,
+        config.MIN_PRICE_TO_IGNORE,
+    )
+
+
+def parse_rules(raw: str) -> PriceRules:
+    data = json.loads(raw)
+    rules = [
+        PriceRule(
+            match=str(item["match"]),
+            delta=float(item["delta"]),
+            channels=tuple(str(c) for c in item.get("channels", ())),
+            priority=int(item.get("priority", 0)),
+        )
+        for item in data.get("rules", [])
+    ]
+    return PriceRules(
+        rules,
+        float(data.get("default_delta", config.PRICE_DEFAULT_DELTA)),
+        data.get("min_price_to_zero", config.MIN_PRICE_TO_ZERO),
+        float(data.get("min_price_to_ignore", config.MIN_PRICE_TO_IGNORE)),
+    )
+
+
+# ================= ACTIVE RULES =================
+
+_active = default_rules()
+_loaded_at = 0.0
+
+
+def get_active_rules() -> PriceRules:
+    return _active
+
+
+def set_active_rules(rules: PriceRules):
+    """Горячая замена таблицы (текущие обработки доработают со старой)"""
+    global _active
+    if rules.version != _active.version:
+        logger.info(f"Price rules switched: {_active.version} -> {rules.version}")
+    _active = rules
+
+
+async def load_rules_from_db() -> PriceRules:
+    """
+    settings.price_rules, если задан; иначе дельты из админки
+    (price_pro_delta / price_default_delta) или из config.
+    """
+    raw = await db.get_setting(SETTINGS_KEY)
+    if raw:
+        return parse_rules(raw)
+
+    pro = await db.get_setting("price_pro_delta")
+    default = await db.get_setting("price_default_delta")
+    return default_rules(
+        float(pro) if pro else None,
+        float(default) if default else None,
+    )
+
+
+async def reload_rules(force=False) -> PriceRules:
+    """Перечитать правила не чаще PRICE_RULES_RELOAD_INTERVAL"""
+    global _loaded_at
+    now = time.monotonic()
+    if not force and now - _loaded_at < config.PRICE_RULES_RELOAD_INTERVAL:
+        return _active
+
+    _loaded_at = now
+    try:
+        set_active_rules(await load_rules_from_db())
+    except Exception as e:
+        logger.error(f"Price rules reload failed, keeping {_active.version}: {e}")
+    return _active
@@ -0,0 +1,30 @@
+# app/priority.py
+# Классы приоритета публикации: новые посты, правки с изменением цен,
+# косметические правки, backfill. Ключ очереди — время постановки плюс
+# класс * PRIORITY_AGING секунд: младший класс обгоняют только те, кто
+# пришёл не позже чем через класс * PRIORITY_AGING после него, — голодания нет.
+
+import contextvars
+import itertools
+import time
+
+from . import config
+
+NEW, PRICE_EDIT, EDIT, BACKFILL = range(4)
+NAMES = ("new", "price_edit", "edit", "backfill")
+
+# ключ публикуемого сообщения — по нему ведра rate_limit пропускают вызовы бота
+current = contextvars.ContextVar("priority_key", default=None)
+
+_seq = itertools.count()
+
+
+def stamp() -> tuple:
+    """(момент постановки, порядковый номер)"""
+    return time.monotonic(), next(_seq)
+
+
+def make_key(level: int, since: tuple = None) -> tuple:
+    """Меньше — раньше; при равном классе — в порядке постановки"""
+    moment, seq = since or stamp()
+    return moment + level * config.PRIORITY_AGING, seq
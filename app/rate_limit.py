@@ -0,0 +1,124 @@
+# app/rate_limit.py
+# Ограничитель частоты вызовов бота: token bucket на (семейство методов, чат).
+# Скорость подбирается по AIMD: каждый успешный вызов понемногу её
+# поднимает, FloodWait — режет вдвое и закрывает ведро до конца ожидания.
+# Выученные скорости хранятся в settings.rate_limits между запусками.
+
+import asyncio
+import heapq
+import json
+import time
+
+from . import config, db, priority
+from .logger import logger
+
+SETTINGS_KEY = "rate_limits"
+
+SEND_METHODS = {
+    "send_message", "send_photo", "send_video", "send_cached_media",
+    "copy_message", "send_media_group", "copy_media_group",
+}
+
+
+def family_of(method_name: str) -> str:
+    """messages.Send* / messages.EditMessage / прочее"""
+    if method_name in SEND_METHODS:
+        return "send"
+    if method_name.startswith("edit_message"):
+        return "edit"
+    return "other"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate            # вызовов в секунду
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0    # конец FloodWait
+        self.floods = 0
+        self._waiters = []          # куча (ключ приоритета, Event)
+
+    async def acquire(self, cost: int = 1):
+        """
+        Ожидающие проходят по одному в порядке ключа priority.current
+        (вызовы вне диспетчера — как новые посты)
+        """
+        entry = (priority.current.get() or priority.make_key(priority.NEW), asyncio.Event())
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                if self._waiters[0] is not entry:
+                    entry[1].clear()
+                    await entry[1].wait()
+                    continue
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= cost  # альбом уходит в долг
+                        return
+                    delay = (1 - self.tokens) / self.rate
+                # первым мог встать более важный вызов — тогда уступаем ему, проснувшись
+                try:
+                    await asyncio.wait_for(entry[1].wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                entry[1].clear()
+        finally:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            if self._waiters:
+                self._waiters[0][1].set()
+
+    def on_success(self):
+        self.rate = min(config.RATE_LIMIT_MAX, self.rate + config.RATE_LIMIT_INCREASE)
+
+    def on_flood(self, seconds: float):
+        self.floods += 1
+        self.rate = max(config.RATE_LIMIT_MIN, self.rate * config.RATE_LIMIT_DECREASE)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    def __init__(self):
+        self.buckets = {}   # "семейство:чат" -> TokenBucket
+        self.learned = {}   # скорости из прошлых запусков
+
+    def bucket(self, method_name: str, chat_id) -> TokenBucket:
+        family = family_of(method_name)
+        key = f"{family}:{chat_id}"
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            default = config.RATE_LIMIT_EDIT if family == "edit" else config.RATE_LIMIT_SEND
+            rate = self.learned.get(key, default)
+            bucket = self.buckets[key] = TokenBucket(rate, config.RATE_LIMIT_BURST)
+        return bucket
+
+    async def load(self):
+        raw = await db.get_setting(SETTINGS_KEY)
+        if not raw:
+            return
+        try:
+            self.learned = {key: float(rate) for key, rate in json.loads(raw).items()}
+        except (ValueError, AttributeError) as e:
+            logger.warning(f"Bad {SETTINGS_KEY} in settings, ignoring: {e}")
+            return
+        logger.info(f"Rate limits loaded: {self.learned}")
+
+    async def save(self):
+        rates = {**self.learned, **{key: round(b.rate, 4) for key, b in self.buckets.items()}}
+        if rates:
+            await db.set_setting(SETTINGS_KEY, json.dumps(rates, sort_keys=True))
+
+    def stats(self) -> str:
+        return ", ".join(
+            f"{key}={b.rate:.3f}/s floods={b.floods}" for key, b in sorted(self.buckets.items())
+        ) or "no calls"
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,43 @@
+# app/resync.py
+# Перепроверка уже опубликованных постов без листания истории:
+# id исходников берём из таблицы messages и запрашиваем пачками
+# через get_messages (до 200 id за вызов). В обработку уходят
+# только сообщения, которые изменились с прошлого раза.
+
+import asyncio
+from datetime import datetime, timedelta
+
+from pyrogram import Client
+
+from . import config, db, source_state
+from .logger import logger
+
+
+async def resync_channel(client: Client, src, submit):
+    """submit(msg, states) -> Future[bool] — постановка сообщения в диспетчер"""
+    chat = await client.get_chat(src)
+    source_channel = str(chat.id)
+
+    since = (datetime.utcnow() - timedelta(days=config.RESYNC_DAYS)).isoformat()
+    ids = await db.get_known_message_ids(source_channel, since)
+    logger.info(f"RESYNC {src}: {len(ids)} known messages for the last {config.RESYNC_DAYS:g} days")
+
+    batch_size = config.RESYNC_BATCH_SIZE
+    changed = 0
+    futures = []
+
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        messages = await client.get_messages(chat.id, batch)
+        states = await db.get_message_states(source_channel, batch)
+
+        for m in sorted((m for m in messages if m and not m.empty), key=lambda m: m.id):
+            if source_state.is_unchanged(states.get(m.id), *source_state.source_version(m)):
+                continue
+
+            changed += 1
+            logger.info(f"Resync message {m.id} (changed at source)")
+            futures.append(submit(m, states))
+
+    await asyncio.gather(*futures)
+    logger.info(f"✅ Resync {src}: {changed} of {len(ids)} messages changed")
@@ -0,0 +1,79 @@
+# app/retry.py
+# Политика повторов вызовов бота по классам исключений pyrogram.
+# Повторяются только временные ошибки (500/503, сеть, таймаут правки),
+# с экспоненциальной паузой и полным джиттером, в пределах общего бюджета
+# повторов сообщения. Ошибки запроса (400/401/403/406: неверный peer,
+# длинная подпись, нет прав) повтором не лечатся — сразу отказ.
+
+import asyncio
+import contextvars
+import random
+
+from pyrogram.errors import (
+    RPCError, SeeOther, BadRequest, Unauthorized, Forbidden, NotAcceptable,
+    Flood, InternalServerError, ServiceUnavailable, MessageNotModified,
+)
+
+from . import config
+from .rate_limit import family_of
+
+DONE = "done"       # менять нечего — считаем успехом
+FLOOD = "flood"     # ждать в ведре rate_limit и повторить
+RETRY = "retry"     # повторить после паузы, если позволяет бюджет
+FATAL = "fatal"     # не повторять
+UNKNOWN = "unknown" # отправка могла дойти — не повторять и не слать другим способом
+
+# первое совпадение по isinstance; порядок важен (MessageNotModified — BadRequest)
+RULES = (
+    (MessageNotModified, DONE),
+    (Flood, FLOOD),                  # FloodWait, SlowmodeWait
+    (InternalServerError, RETRY),
+    (ServiceUnavailable, RETRY),     # в т.ч. Timeout от Telegram
+    (SeeOther, RETRY),
+    (BadRequest, FATAL),
+    (Unauthorized, FATAL),
+    (Forbidden, FATAL),
+    (NotAcceptable, FATAL),
+    (RPCError, RETRY),               # неизвестные коды
+    (OSError, RETRY),                # сеть
+)
+
+# загрузка файла дольше обычного вызова
+UPLOAD_METHODS = {"send_photo", "send_video", "send_media_group", "edit_message_media"}
+
+
+def classify(error: Exception, method_name: str) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        # отправка могла дойти, а ответ — потеряться: повтор рискует дублем поста,
+        # пропущенное же сообщение опубликует следующий запуск
+        return UNKNOWN if family_of(method_name) == "send" else RETRY
+    for errors, action in RULES:
+        if isinstance(error, errors):
+            return action
+    return FATAL
+
+
+def timeout_for(method_name: str) -> float:
+    return config.UPLOAD_TIMEOUT if method_name in UPLOAD_METHODS else config.REQUEST_TIMEOUT
+
+
+def backoff(attempt: int) -> float:
+    """Пауза перед повтором: случайная от 0 до min(потолок, база * 2^attempt)"""
+    return random.uniform(0, min(config.RETRY_BACKOFF_MAX, config.RETRY_BACKOFF * 2 ** attempt))
+
+
+class Budget:
+    """Повторы, оставшиеся у сообщения на все его вызовы бота"""
+
+    def __init__(self, retries: int = None):
+        self.left = config.RETRY_BUDGET if retries is None else retries
+
+    def take(self) -> bool:
+        if self.left <= 0:
+            return False
+        self.left -= 1
+        return True
+
+
+# бюджет публикуемого сообщения (задаёт диспетчер); вне его — свой на каждый вызов
+budget = contextvars.ContextVar("retry_budget", default=None)
@@ -0,0 +1,46 @@
+# app/source_state.py
+# Версия исходного сообщения: дата правки + хэш сырого текста
+# (с учётом версии правил цен). По ней понимаем, что пересчитывать нечего.
+
+from pyrogram.types import Message
+
+from . import price_rules, text_cache
+
+
+def raw_text(msg: Message) -> str:
+    return (msg.text or "") + (msg.caption or "")
+
+
+def source_edit_date(msg: Message):
+    """Дата последней правки исходника (unix time) или None"""
+    return int(msg.edit_date.timestamp()) if msg.edit_date else None
+
+
+def rules_for(msg: Message):
+    return price_rules.get_active_rules().for_channel(msg.chat.id, msg.chat.username)
+
+
+def source_version(msg: Message, rules=None):
+    """(edit_date, raw_hash); raw_hash совпадает с ключом text_cache"""
+    rules = rules or rules_for(msg)
+    return source_edit_date(msg), text_cache.make_key(raw_text(msg), rules.version)
+
+
+def is_unchanged(state, edit_date, raw_hash) -> bool:
+    """Сообщение уже опубликовано и с тех пор не менялось"""
+    return bool(
+        state
+        and state["target_message_id"]
+        and state["raw_hash"] == raw_hash
+        and state["source_edit_date"] == edit_date
+    )
+
+
+def is_skipped(state, edit_date, raw_hash) -> bool:
+    """Участник альбома уже разобран — публиковать нечего — и с тех пор не менялся"""
+    return bool(
+        state
+        and not state["target_message_id"]
+        and state["raw_hash"] == raw_hash
+        and state["source_edit_date"] == edit_date
+    )
@@ -0,0 +1,97 @@
+# app/text_cache.py
+# LRU-кэш результата clean_text + замены цен.
+# Ключ — хэш сырого текста и версии правил цен, поэтому повторные
+# прогоны по тем же прайсам не пересчитывают текст заново.
+
+import hashlib
+import time
+from collections import OrderedDict
+
+from . import config, db
+from .logger import logger
+
+# Поднять при изменении clean_text / utils_price, чтобы не взять старые результаты из БД
+PIPELINE_VERSION = 1
+
+
+def make_key(raw: str, rules_version: str) -> str:
+    h = hashlib.sha1(f"{PIPELINE_VERSION}:{rules_version}:".encode())
+    h.update(raw.encode("utf-8", "surrogatepass"))
+    return h.hexdigest()
+
+
+def text_fingerprint(text: str) -> str:
+    """Отпечаток полного текста поста: длина + sha1 (summary в БД обрезан до 800)"""
+    data = text.encode("utf-8", "surrogatepass")
+    return f"{len(text)}:{hashlib.sha1(data).hexdigest()}"
+
+
+class TransformCache:
+    """Ограничен и по числу записей, и по суммарной длине текстов"""
+
+    def __init__(self, max_entries: int, max_chars: int):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.entries = OrderedDict()  # key -> (text, changed, used_at)
+        self.chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.entries[key] = (entry[0], entry[1], time.time())
+        return entry[0], entry[1]
+
+    def put(self, key, text: str, changed: bool, used_at=None):
+        old = self.entries.pop(key, None)
+        if old:
+            self.chars -= len(old[0])
+
+        self.entries[key] = (text, changed, used_at or time.time())
+        self.chars += len(text)
+
+        while self.entries and (
+            len(self.entries) > self.max_entries or self.chars > self.max_chars
+        ):
+            _, (evicted, _, _) = self.entries.popitem(last=False)
+            self.chars -= len(evicted)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (
+            f"hits={self.hits} misses={self.misses} ({rate:.0f}%) "
+            f"entries={len(self.entries)} chars={self.chars}"
+        )
+
+
+transform_cache = TransformCache(config.TRANSFORM_CACHE_SIZE, config.TRANSFORM_CACHE_MAX_CHARS)
+
+
+async def load():
+    """Прогреть кэш из reposter.db (для cron-запусков)"""
+    if not config.TRANSFORM_CACHE_PERSIST:
+        return
+
+    rows = await db.load_transform_cache(config.TRANSFORM_CACHE_PERSIST_LIMIT)
+    # самые свежие пришли первыми — кладём их последними, чтобы были в конце LRU
+    for key, text, changed in reversed(rows):
+        transform_cache.put(key, text, bool(changed))
+    logger.info(f"Transform cache warmed: {len(rows)} entries")
+
+
+async def save():
+    if not config.TRANSFORM_CACHE_PERSIST:
+        return
+
+    limit = config.TRANSFORM_CACHE_PERSIST_LIMIT
+    items = list(transform_cache.entries.items())[-limit:]
+    rows = [(key, text, int(changed), used_at) for key, (text, changed, used_at) in items]
+    await db.save_transform_cache(rows, limit)
+    logger.info(f"Transform cache saved: {len(rows)} entries")
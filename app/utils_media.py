@@ -1,43 +1,225 @@
 # app/utils_media.py
 import asyncio
+import io
+import json
+import os
 from pathlib import Path
+import aiofiles
+import aiofiles.os
 from pyrogram.types import Message
 from pyrogram.errors import FloodWait, RPCError
 from . import config
 from .logger import logger
+from .workspace import workspace, parts_path
 
-DOWNLOAD_DIR = Path(config.DOWNLOAD_DIR)
-DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+CHUNK_SIZE = 1024 * 1024  # размер куска stream_media / get_file
+
+async def _load_parts(path: Path, size: int) -> set:
+    """Готовые куски из .parts (пусто, если файла нет или он от другого размера)"""
+    try:
+        async with aiofiles.open(parts_path(path)) as f:
+            data = json.loads(await f.read())
+    except Exception:
+        return set()
+    if not await aiofiles.os.path.exists(path):
+        return set()
+    return set(data["done"]) if data.get("size") == size else set()
+
+async def _save_parts(path: Path, size: int, done: set):
+    async with aiofiles.open(parts_path(path), "w") as f:
+        await f.write(json.dumps({"size": size, "done": sorted(done)}))
+
+def _split_ranges(missing: list, workers: int) -> list:
+    """Недостающие куски -> сплошные диапазоны (offset, count), примерно поровну на воркера"""
+    per = max(1, -(-len(missing) // workers))
+    ranges = []
+    for i in missing:
+        if ranges and ranges[-1][0] + ranges[-1][1] == i and ranges[-1][1] < per:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([i, 1])
+    return [tuple(r) for r in ranges]
+
+async def _fetch_range(msg: Message, fd: int, path: Path, size: int, offset: int, count: int, done: set):
+    index = offset
+    async for chunk in msg._client.stream_media(msg, limit=count, offset=offset):
+        await asyncio.to_thread(os.pwrite, fd, chunk, index * CHUNK_SIZE)
+        done.add(index)
+        await _save_parts(path, size, done)
+        index += 1
+
+def _preallocate(path: Path, size: int, keep: bool):
+    with open(path, "r+b" if keep else "wb") as f:
+        f.truncate(size)
+
+async def download_ranges(msg: Message, max_retries=None) -> Path | None:
+    """
+    Большой файл — несколькими параллельными диапазонами stream_media
+    в заранее выделенный файл. Параллельность ограничена
+    max_concurrent_transmissions клиента (семафор get_file в pyrogram).
+    Готовые куски отмечаются в <файл>.parts: после сбоя или таймаута
+    скачивание продолжается с них, а не с нуля.
+    """
+    media = msg.photo or msg.video
+    size = media.file_size
+    total = -(-size // CHUNK_SIZE)
+    workers = max(1, msg._client.max_concurrent_transmissions)
+    # не в папке запуска: недокачанный файл должен пережить перезапуск
+    path = workspace.partial_dir / media_disk_name(msg)
 
-async def download_media(msg: Message, max_retries=None) -> Path | None:
     retries = max_retries or config.DOWNLOAD_RETRIES
     attempt = 0
+    done = set()
+    fd = None
+    try:
+        await workspace.reserve(path, size)
+        done = await _load_parts(path, size)
+        if done:
+            logger.info(f"Resuming {path.name}: {len(done)}/{total} chunks ready")
+        await asyncio.to_thread(_preallocate, path, size, bool(done))
+        fd = os.open(path, os.O_WRONLY)
 
-    while attempt < retries:
-        try:
-            path = await msg.download(file_name=str(DOWNLOAD_DIR))
-            if path:
-                return Path(path)
-            return None
-        except FloodWait as fw:
-            logger.warning(f"FloodWait download {fw.value}s")
-            await asyncio.sleep(fw.value + 1)
-        except RPCError as e:
-            logger.warning(f"RPCError download {e}")
-            attempt += 1
-            await asyncio.sleep(1 + attempt)
-        except Exception:
-            logger.exception("DOWNLOAD ERROR")
-            attempt += 1
-            await asyncio.sleep(1 + attempt)
+        while attempt < retries:
+            missing = [i for i in range(total) if i not in done]
+            if not missing:
+                break
+            results = await asyncio.gather(*(
+                _fetch_range(msg, fd, path, size, offset, count, done)
+                for offset, count in _split_ranges(missing, workers)
+            ), return_exceptions=True)
+            errors = [r for r in results if isinstance(r, Exception)]
+            if not errors:
+                if len(done) < total:  # поток закончился раньше времени
+                    attempt += 1
+                continue
+
+            error = errors[0]
+            if isinstance(error, FloodWait):
+                logger.warning(f"FloodWait download {error.value}s")
+                await asyncio.sleep(error.value + 1)
+            else:
+                logger.warning(f"Download error {path.name}: {error}")
+                attempt += 1
+                await asyncio.sleep(1 + attempt)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if len(done) < total:
+            # файл и .parts остаются для докачки, квоту отпускаем
+            await workspace.release(path)
+
+    if len(done) < total:
+        logger.error("DOWNLOAD FAILED")
+        return None
+
+    await aiofiles.os.remove(parts_path(path))
+    return path
 
-    logger.error("DOWNLOAD FAILED")
+def media_file_name(msg: Message) -> str:
+    if msg.video:
+        return msg.video.file_name or f"video_{msg.id}.mp4"
+    return f"photo_{msg.id}.jpg"
+
+def media_disk_name(msg: Message) -> str:
+    """
+    Имя в workspace — по file_unique_id: два разных видео с одним file_name
+    не пишут в один файл, а докачка находит свой
+    """
+    media = msg.photo or msg.video
+    return f"{msg.chat.id}_{media.file_unique_id}{Path(media_file_name(msg)).suffix}"
+
+async def fetch_media(msg: Message, max_retries=None):
+    """
+    Медиа для загрузки ботом без записи на диск: stream_media кусками
+    по 1 МБ в BytesIO (с .name, как ждёт pyrogram). Файлы крупнее
+    MEDIA_MEMORY_LIMIT — и те, что оказались крупнее по ходу
+    скачивания, — уходят на диск (workspace). Возвращает BytesIO, Path или None.
+    """
+    media = msg.photo or msg.video
+    limit = config.MEDIA_MEMORY_LIMIT
+    if media and media.file_size and media.file_size > limit:
+        return await download_ranges(msg, max_retries)
+
+    retries = max_retries or config.DOWNLOAD_RETRIES
+    attempt = 0
+    name = media_file_name(msg)
+    buffer = io.BytesIO()
+    buffer.name = name
+    out, path = None, None  # out — файл на диске после перелива
+    chunks = 0  # после сбоя продолжаем с того же куска
+
+    try:
+        while attempt < retries:
+            try:
+                async for chunk in msg._client.stream_media(msg, offset=chunks):
+                    chunks += 1
+                    if out:
+                        await out.write(chunk)
+                        continue
+                    buffer.write(chunk)
+                    if buffer.tell() > limit:
+                        path = workspace.run_dir / media_disk_name(msg)
+                        await workspace.reserve(path, max(buffer.tell(), media.file_size or 0))
+                        out = await aiofiles.open(path, "wb")
+                        await out.write(buffer.getvalue())
+                        buffer.close()
+
+                if out:
+                    await out.close()
+                    return path
+                buffer.seek(0)
+                return buffer
+            except FloodWait as fw:
+                logger.warning(f"FloodWait stream {fw.value}s")
+                await asyncio.sleep(fw.value + 1)
+            except RPCError as e:
+                logger.warning(f"RPCError stream {e}")
+                attempt += 1
+                await asyncio.sleep(1 + attempt)
+            except Exception:
+                logger.exception("STREAM ERROR")
+                attempt += 1
+                await asyncio.sleep(1 + attempt)
+    except BaseException:
+        if out:
+            await out.close()
+        await cleanup_files([buffer, path])
+        raise
+
+    if out:
+        await out.close()
+    await cleanup_files([buffer, path])
+    logger.error("STREAM FAILED")
     return None
 
-def cleanup_files(paths):
+async def spill_to_disk(msg: Message, media_file):
+    """BytesIO -> файл в папке запуска (для вызовов, которым нужен путь); файл — как есть"""
+    if not isinstance(media_file, io.BytesIO):
+        return media_file
+    path = workspace.run_dir / media_disk_name(msg)
+    try:
+        await workspace.reserve(path, media_file.getbuffer().nbytes)
+        async with aiofiles.open(path, "wb") as f:
+            await f.write(media_file.getvalue())
+    except BaseException:
+        await workspace.remove(path)
+        raise
+    finally:
+        media_file.close()
+    return path
+
+def upload_arg(media_file):
+    """Что передать в send_*/InputMedia*: BytesIO как есть, файл — путём"""
+    if media_file is None or isinstance(media_file, io.IOBase):
+        return media_file
+    return str(media_file)
+
+async def cleanup_files(paths):
     for p in paths:
         try:
-            if p and p.exists():
-                p.unlink()
+            if isinstance(p, io.IOBase):
+                p.close()
+            elif p:
+                await workspace.remove(Path(p))
         except Exception:
             pass
@@ -103,6 +103,61 @@ def replace_phones_emoji(text: str) -> str:
     """
     return text.replace("📱📱📱", "@perviykremlevskiy 📱")
 
+# ================== TOKENIZER ==================
+
+# Маркер абзаца с уценкой (см. remove_discount_paragraph)
+DISCOUNT_KEYWORD = "уценка"
+
+# Модельное слово: \b(pro max|pro)\b срабатывает ровно тогда, когда есть отдельное слово "pro"
+PRO_KEYWORD = "pro"
+
+# Все границы строк, которые понимает str.splitlines()
+LINE_BREAKS = ("\r\n", "\n", "\r", "\x0b", "\x0c", "\x1c", "\x1d", "\x1e", "\x85", "\u2028", "\u2029")
+
+
+def _build_token_re() -> re.Pattern:
+    """
+    Один регэксп на весь текст (по text.lower()): переводы строк,
+    числа-кандидаты в цены, маркер уценки и стоп-слова строк.
+
+    Каждая альтернатива начинается с литерала — так re заранее
+    строит набор первых символов и быстро проматывает «пустой» текст.
+    Поэтому групп нет, а тип токена определяется по самому токену.
+    Число — максимальный отрезок из цифр и точек длиной от 5 символов
+    (короче цены не бывает), цены внутри него ищет PRICE_RE.
+    "pro" — кандидат в PRO_LINE_RE, границы слова проверяются отдельно.
+    """
+    alternatives = [re.escape(br) for br in LINE_BREAKS]
+    alternatives += [rf"{d}[\d.]{{4,}}" for d in "0123456789"]
+    alternatives += [re.escape(k) for k in [DISCOUNT_KEYWORD, *IGNORE_LINE_KEYWORDS]]
+    alternatives.append(PRO_KEYWORD)
+    return re.compile("|".join(alternatives))
+
+
+TOKEN_RE = _build_token_re()
+_LINE_BREAK_SET = frozenset(LINE_BREAKS)
+_DIGITS = frozenset("0123456789")
+
+# цифры вне ASCII (арабские, деванагари...) — \d их ловит, TOKEN_RE нет
+NON_ASCII_DIGIT_RE = re.compile(r"[^\D0-9]")
+
+
+def _is_word_char(c: str) -> bool:
+    """То же, что \\w в re для str"""
+    return c.isalnum() or c == "_"
+
+
+def _new_price(raw_price: str, delta, min_zero, min_ignore):
+    """Новая цена строкой или None, если цену трогать нельзя"""
+    new_price = normalize_price(raw_price) - delta
+
+    if new_price <= min_ignore:
+        return None
+    if new_price < min_zero:
+        new_price = min_zero
+
+    return format_price(new_price)
+
 # ================== CORE FUNCTION ==================
 
 def replace_prices_in_text(
@@ -111,6 +166,142 @@ def replace_prices_in_text(
     default_delta: int,
     min_zero: int = 0,
     min_ignore: int = 0
+):
+    """
+    Однопроходная версия replace_prices_in_text_linewise — результат
+    (текст и флаг changed) совпадает с ней байт в байт.
+
+    - текст токенизируется один раз (TOKEN_RE по text.lower())
+    - Pro / Pro Max, стоп-слова и уценка — тоже токены, без поиска по строкам
+    - абзац с уценкой вырезается сразу при сборке результата
+    """
+    return _replace_prices(text, pro_delta, default_delta, min_zero, min_ignore)
+
+
+def replace_prices_by_rules(text: str, rules):
+    """
+    То же, что replace_prices_in_text, но дельта строки берётся
+    из таблицы правил (price_rules.ChannelPriceRules), а не pro/default.
+    """
+    return _replace_prices(
+        text, None, None, rules.min_zero, rules.min_ignore, rules.delta_for
+    )
+
+
+def _replace_prices(
+    text: str,
+    pro_delta,
+    default_delta,
+    min_zero,
+    min_ignore,
+    delta_for=None
+):
+    """delta_for(строка) -> дельта; без него — pro/default"""
+
+    source = text
+
+    # ШАГ 1: Заменяем эмодзи телефонов
+    text = replace_phones_emoji(text)
+
+    lowered = text.lower()
+    if len(lowered) != len(text) or (
+        not text.isascii() and NON_ASCII_DIGIT_RE.search(text)
+    ):
+        # редкие символы, у которых lower() меняет длину (например "İ"),
+        # или цифры вне ASCII: токенизатор их не понимает
+        return replace_prices_in_text_linewise(
+            source, pro_delta, default_delta, min_zero, min_ignore, delta_for
+        )
+
+    # ШАГ 2: Режем текст на строки, запоминая токены каждой строки
+    # строка: (start, end, ignore, discount, pro, [(price_start, price_end), ...])
+    lines = []
+    start = 0
+    ignore = discount = pro = False
+    prices = []
+    size = len(text)
+
+    for m in TOKEN_RE.finditer(lowered):
+        token = m.group()
+        if token[0] in _DIGITS:
+            offset = m.start()
+            for p in PRICE_RE.finditer(token):
+                prices.append((offset + p.start(), offset + p.end()))
+        elif token in _LINE_BREAK_SET:
+            lines.append((start, m.start(), ignore, discount, pro, prices))
+            start = m.end()
+            ignore = discount = pro = False
+            prices = []
+        elif token == PRO_KEYWORD:
+            left, right = m.span()
+            if not (left and _is_word_char(lowered[left - 1])) and not (
+                right < size and _is_word_char(lowered[right])
+            ):
+                pro = True
+        elif token == DISCOUNT_KEYWORD:
+            discount = True
+        else:
+            ignore = True
+
+    # как у splitlines(): пустой хвост после последнего перевода строки не считается
+    if start < size:
+        lines.append((start, size, ignore, discount, pro, prices))
+
+    # remove_discount_paragraph заново режет уже склеенный текст
+    # и теряет последнюю пустую строку — повторяем это
+    if lines and lines[-1][0] == lines[-1][1]:
+        lines.pop()
+
+    # ШАГ 3: Собираем результат, заменяя цены и вырезая уценку
+    changed = False
+    out = []
+    skipping = False  # внутри абзаца с уценкой
+
+    for start, end, ignore, discount, pro, prices in lines:
+        if skipping:
+            keep = False
+            if not text[start:end].strip():
+                skipping = False  # пустая строка после уценки тоже удаляется
+        elif discount:
+            keep = False
+            skipping = True
+        else:
+            keep = True
+
+        if ignore or not prices or (not keep and changed):
+            if keep:
+                out.append(text[start:end])
+            continue
+
+        if delta_for:
+            delta = delta_for(lowered[start:end])
+        else:
+            delta = pro_delta if pro else default_delta
+        pieces = []
+        pos = start
+        for p_start, p_end in prices:
+            new = _new_price(text[p_start:p_end], delta, min_zero, min_ignore)
+            if new is None:
+                continue
+            changed = True
+            pieces.append(text[pos:p_start])
+            pieces.append(new)
+            pos = p_end
+
+        if keep:
+            pieces.append(text[pos:end])
+            out.append("".join(pieces))
+
+    return "\n".join(out), changed
+
+
+def replace_prices_in_text_linewise(
+    text: str,
+    pro_delta: int,
+    default_delta: int,
+    min_zero: int = 0,
+    min_ignore: int = 0,
+    delta_for=None
 ):
     """
     ЛОГИКА (ВАЖНО):
@@ -120,6 +311,9 @@ def replace_prices_in_text(
     - "17 256" НЕ ТРОГАЕМ
     - Удаляет абзацы с уценкой
     - Заменяет 📱📱📱 на @perviykremlevskiy 📱
+
+    Эталонная (многопроходная) реализация: используется как запасной путь
+    и для сравнения в bench/bench_price.py.
     """
     
     # ШАГ 1: Заменяем эмодзи телефонов
@@ -137,7 +331,10 @@ def replace_prices_in_text(
             new_lines.append(line)
             continue
 
-        pro_line = is_pro_line(line)
+        if delta_for:
+            line_delta = delta_for(line)
+        else:
+            line_delta = pro_delta if is_pro_line(line) else default_delta
 
         def repl(m):
             nonlocal changed
@@ -145,7 +342,7 @@ def replace_prices_in_text(
 
             price = normalize_price(raw_price)
 
-            delta = pro_delta if pro_line else default_delta
+            delta = line_delta
             new_price = price - delta
 
             if new_price <= min_ignore:
@@ -0,0 +1,105 @@
+# app/workspace.py
+# Рабочая папка медиа (DOWNLOAD_DIR). Файловые операции идут через aiofiles,
+# вне цикла asyncio. У каждого запуска своя подпапка run-*, докачиваемые
+# между запусками файлы лежат в partial/. При старте уборщик удаляет всё,
+# что старше MEDIA_STALE_AGE (остатки упавших и убитых по таймауту запусков),
+# а в partial/ — старше MEDIA_PARTIAL_STALE_AGE: докачка ждёт следующего запуска.
+# Квота MEDIA_DISK_QUOTA придерживает новые скачивания, пока место не освободится.
+
+import asyncio
+import os
+import shutil
+import time
+from pathlib import Path
+
+import aiofiles.os
+
+from . import config
+from .logger import logger
+
+
+def parts_path(path: Path) -> Path:
+    """Сайдкар докачки (см. utils_media.download_ranges)"""
+    return path.with_name(path.name + ".parts")
+
+
+class MediaWorkspace:
+    def __init__(self, root: Path, quota: int, stale_age: float, partial_age: float):
+        self.root = root
+        self.run_dir = root / f"run-{int(time.time())}-{os.getpid()}"
+        self.partial_dir = root / "partial"
+        self.quota = quota          # байт; 0 — без ограничения
+        self.stale_age = stale_age  # сек
+        self.partial_age = partial_age
+        self.reserved = {}          # путь -> байт
+        self._changed = asyncio.Condition()
+
+    @property
+    def used(self) -> int:
+        return sum(self.reserved.values())
+
+    async def start(self):
+        await aiofiles.os.makedirs(self.run_dir, exist_ok=True)
+        await aiofiles.os.makedirs(self.partial_dir, exist_ok=True)
+        await self.sweep()
+
+    async def close(self):
+        """Удалить папку запуска (всё, что в ней осталось, больше не нужно)"""
+        await asyncio.to_thread(shutil.rmtree, self.run_dir, True)
+        self.reserved = {p: size for p, size in self.reserved.items() if self.run_dir not in p.parents}
+
+    async def sweep(self):
+        """Удалить устаревшие файлы и папки чужих запусков"""
+        now = time.time()
+        removed = 0
+        for directory, age in ((self.root, self.stale_age), (self.partial_dir, self.partial_age)):
+            cutoff = now - age
+            for entry in await aiofiles.os.scandir(directory):
+                path = Path(entry.path)
+                if path in (self.run_dir, self.partial_dir):
+                    continue
+                try:
+                    if (await aiofiles.os.stat(path)).st_mtime > cutoff:
+                        continue
+                    if entry.is_dir():
+                        await asyncio.to_thread(shutil.rmtree, path, True)
+                    else:
+                        await aiofiles.os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        if removed:
+            logger.info(f"Media workspace: removed {removed} stale entries from {self.root}")
+
+    async def reserve(self, path: Path, size: int):
+        """
+        Занять size байт квоты под файл, дождавшись места.
+        Файл больше всей квоты пропускается, когда больше ничего не скачивается.
+        """
+        if not self.quota:
+            return
+        async with self._changed:
+            if self.reserved and self.used + size > self.quota:
+                logger.info(f"Disk quota: waiting to download {path.name} ({size} bytes)")
+            await self._changed.wait_for(lambda: not self.reserved or self.used + size <= self.quota)
+            self.reserved[Path(path)] = size
+
+    async def release(self, path: Path):
+        if not self.quota:
+            return
+        async with self._changed:
+            if self.reserved.pop(Path(path), None) is not None:
+                self._changed.notify_all()
+
+    async def remove(self, path: Path):
+        for p in (path, parts_path(path)):
+            try:
+                await aiofiles.os.remove(p)
+            except FileNotFoundError:
+                pass
+        await self.release(path)
+
+
+workspace = MediaWorkspace(
+    Path(config.DOWNLOAD_DIR), config.MEDIA_DISK_QUOTA, config.MEDIA_STALE_AGE, config.MEDIA_PARTIAL_STALE_AGE
+)
@@ -0,0 +1,86 @@
+# bench/bench_db.py
+# Записей в messages в секунду: коммит на каждую запись в rollback-журнале
+# (как было) против group commit + WAL из app/db.py.
+# Запуск: python bench/bench_db.py [кол-во записей]
+
+import asyncio
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+import aiosqlite
+
+from app import db
+
+UPSERT = """
+    INSERT OR REPLACE INTO messages (
+        source_channel, source_message_id,
+        target_message_id, message_type,
+        processed_at, summary
+    )
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+
+def _row(i):
+    return ("-100123", i, i + 1, "text", "2025-12-15T19:10:39", "15.12.2025 Прайс " * 40)
+
+
+async def bench_commit_per_row(path: Path, rows: int) -> float:
+    conn = await aiosqlite.connect(str(path))
+    await conn.execute("PRAGMA journal_mode = DELETE")
+    await conn.execute("PRAGMA synchronous = FULL")
+    await conn.execute("""
+        CREATE TABLE messages (
+            source_channel TEXT NOT NULL,
+            source_message_id INTEGER NOT NULL,
+            target_message_id INTEGER,
+            message_type TEXT DEFAULT 'text',
+            processed_at TEXT,
+            summary TEXT,
+            PRIMARY KEY (source_channel, source_message_id)
+        )
+    """)
+    await conn.commit()
+
+    started = time.perf_counter()
+    for i in range(rows):
+        await conn.execute(UPSERT, _row(i))
+        await conn.commit()
+    elapsed = time.perf_counter() - started
+
+    await conn.close()
+    return rows / elapsed
+
+
+async def bench_group_commit(path: Path, rows: int) -> float:
+    db.DB_PATH = path
+    await db.init_db()
+
+    started = time.perf_counter()
+    for i in range(rows):
+        channel, msg_id, target_id, message_type, processed_at, summary = _row(i)
+        await db.update_message_target(channel, msg_id, target_id, processed_at, summary, message_type)
+    await db.flush()
+    elapsed = time.perf_counter() - started
+
+    await db.close_db()
+    return rows / elapsed
+
+
+async def run(rows: int = 2000):
+    with tempfile.TemporaryDirectory() as tmp:
+        before = await bench_commit_per_row(Path(tmp) / "before.db", rows)
+        after = await bench_group_commit(Path(tmp) / "after.db", rows)
+
+    print(f"rows={rows}")
+    print(f"  commit per row (DELETE, FULL): {before:,.0f} rows/s")
+    print(f"  group commit (WAL, NORMAL):    {after:,.0f} rows/s")
+    print(f"  speedup:                       x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run(int(sys.argv[1]) if len(sys.argv) > 1 else 2000))
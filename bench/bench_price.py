@@ -0,0 +1,60 @@
+# bench/bench_price.py
+# Сравнение однопроходного replace_prices_in_text с построчной версией
+# на больших прайсах. Запуск: python bench/bench_price.py [кол-во строк]
+
+import random
+import sys
+import timeit
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from app.utils_price import replace_prices_in_text, replace_prices_in_text_linewise
+
+MODELS = [
+    "iPhone 17 Pro Max 256 🇺🇸", "iPhone 17 Pro 512", "iPhone 17 Air 256",
+    "iPhone 16 128 Black", "Samsung S25 Ultra 12/256", "MacBook Air 13 M4",
+    "iPad Pro 11 M4 Wi-Fi", "AirPods Pro 2", "Чехол MagSafe", "Dyson V15",
+]
+EXTRA_LINES = [
+    "", "Гарантия 12 месяцев", "В пути, ожидаем 17 256 шт", "📱📱📱",
+    "Уценка", "iPhone 15 Pro 256 - 70.000 (вскрыт)",
+]
+
+
+def make_price_list(lines_count: int, seed: int = 1) -> str:
+    rnd = random.Random(seed)
+    lines = ["15.12.2025 Прайс"]
+    for _ in range(lines_count):
+        if rnd.random() < 0.15:
+            lines.append(rnd.choice(EXTRA_LINES))
+            continue
+        price = rnd.randint(8, 260) * 500
+        raw = f"{price:,}".replace(",", ".") if rnd.random() < 0.7 else str(price)
+        lines.append(f"{rnd.choice(MODELS)} - {raw}")
+    return "\n".join(lines)
+
+
+def run(lines_count: int = 500, repeat: int = 200):
+    text = make_price_list(lines_count)
+    args = (2000.0, 1000.0, True, 10000.0)
+
+    assert replace_prices_in_text(text, *args) == replace_prices_in_text_linewise(text, *args)
+
+    # замеры чередуются, берётся лучший — фоновая нагрузка не достаётся одной версии
+    rounds = 7
+    number = max(1, repeat // rounds)
+    old = new = float("inf")
+    for _ in range(rounds):
+        old = min(old, timeit.timeit(lambda: replace_prices_in_text_linewise(text, *args), number=number))
+        new = min(new, timeit.timeit(lambda: replace_prices_in_text(text, *args), number=number))
+    old, new = old / number * repeat, new / number * repeat
+
+    print(f"lines={lines_count} runs={repeat}")
+    print(f"  linewise:    {old / repeat * 1000:.3f} ms/text")
+    print(f"  single-pass: {new / repeat * 1000:.3f} ms/text")
+    print(f"  speedup:     x{old / new:.2f}")
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 500)